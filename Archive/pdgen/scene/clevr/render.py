@@ -127,6 +127,8 @@ def render_scene(args, spec, output_image='render.png', output_json='render_json
     bpy.context.scene.cycles.samples = args.render_num_samples
     bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
     bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
+    if getattr(args, 'render_seed', None) is not None:
+        bpy.context.scene.cycles.seed = args.render_seed
     if args.use_gpu == 1:
         bpy.context.scene.cycles.device = 'GPU'
 
@@ -235,11 +237,16 @@ def render_shadeless(builder, output_path='flat.png'):
     old_filepath = render_args.filepath
     old_engine = render_args.engine
     old_use_antialiasing = render_args.use_antialiasing
+    old_use_raytrace = render_args.use_raytrace
+    old_use_shadows = render_args.use_shadows
 
     # Override some render settings to have flat shading
     render_args.filepath = output_path
     render_args.engine = 'BLENDER_RENDER'
     render_args.use_antialiasing = False
+    # Shadeless materials ignore lighting, so skip building the raytrace tree and shadow buffers
+    render_args.use_raytrace = False
+    render_args.use_shadows = False
 
     # Move the lights and ground to layer 2 so they don't render
     utils.set_layer(bpy.data.objects['Lamp_Key'], 2)
@@ -279,5 +286,7 @@ def render_shadeless(builder, output_path='flat.png'):
     render_args.filepath = old_filepath
     render_args.engine = old_engine
     render_args.use_antialiasing = old_use_antialiasing
+    render_args.use_raytrace = old_use_raytrace
+    render_args.use_shadows = old_use_shadows
     
 
@@ -6,12 +6,11 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile, itertools
+import math, sys, random, argparse, json, os, tempfile, itertools, functools
 import os.path as osp
 from datetime import datetime as dt
 from collections import Counter
 import numpy as np
-import copy
 
 """
 Renders random scenes using Blender, each with with a random number of objects;
@@ -76,34 +75,41 @@ INTRINSIC_PRIMITIVES = {"size": ['small', 'large'], "color": ["gray", "red", "bl
 
 EXTRINSIC_PRIMITIVES = {"Relation": ["left", "right", "behind", "front"]}
 
-with open('../question_generation/synonyms.json', 'r') as f:
-    import json
-    SYNONYMS = json.load(f)
+@functools.lru_cache(maxsize=1)
+def _load_synonyms(path: str):
+    """Load the synonym table once per process, with every color as its own only synonym.
+    The lists are frozen into tuples so the cached table can be shared safely (and by forked workers)."""
+    with open(path, 'r') as f:
+        synonyms = json.load(f)
+    synonyms.update({color: [color] for color in INTRINSIC_PRIMITIVES['color']})
+    return {k: tuple(v) for k, v in synonyms.items()}
 
-for color in INTRINSIC_PRIMITIVES['color']:
-    SYNONYMS[color] = [color]
+SYNONYMS = _load_synonyms('../question_generation/synonyms.json')
+_rng = np.random.default_rng()
+
+def _sample_synonym(value: str):
+    synonyms = SYNONYMS[value]
+    return synonyms[_rng.integers(len(synonyms))]
 
 def sample_attr_object_under_discussion(candidates_: list=['size', 'color', 'material', 'shape'], 
-                                           secondary: bool=False):
+                                           secondary: bool=False, masks: np.ndarray=None):
     # <Size> <Color> <Material> <Shape>
-    masks = np.random.choice(2,len(candidates_)).tolist()
+    if masks is None:
+        masks = _rng.integers(0, 2, size=len(candidates_))
     
     while 1 not in masks:
         if secondary:
-            masks = np.random.choice(2,len(candidates_)).tolist()
+            masks = _rng.integers(0, 2, size=len(candidates_))
         else:
-            return random.sample(SYNONYMS['thing'], 1)[0]+"s", masks, None, candidates_
+            return _sample_synonym('thing')+"s", masks, None, candidates_
     
-    candidates = copy.deepcopy(candidates_)
-    for i, mask in enumerate(masks):
-        if not mask:
-            candidates.pop(i)
+    candidates = [c for c, m in zip(candidates_, masks) if m]
     
     composed_name= []
     attribute_values = []
     for candidate in candidates:
         attr = random.sample(INTRINSIC_PRIMITIVES[candidate], 1)[0]
-        composed_name.append(random.sample(SYNONYMS[attr], 1)[0])
+        composed_name.append(_sample_synonym(attr))
         attribute_values.append(attr) # different instantiations of our synonyms
         
     composed_name = ' '.join(composed_name)
@@ -111,7 +117,18 @@ def sample_attr_object_under_discussion(candidates_: list=['size', 'color', 'mat
     if 'shape' in candidates:
         return composed_name+'s', masks, attribute_values, candidates
     else:
-        return composed_name+' '+random.sample(SYNONYMS['thing'], 1)[0]+"s", masks, attribute_values, candidates
+        return composed_name+' '+_sample_synonym('thing')+"s", masks, attribute_values, candidates
+
+def _drop_attribute_words(name: str, attr: str, is_shape: bool):
+    """Remove the words for `attr` (or any of its synonyms) from the object name; shape words become a generic noun."""
+    synset = set(SYNONYMS.get(attr, (attr, )))
+    tokens = []
+    for token in name.split():
+        if token not in synset and token[:-1] not in synset:
+            tokens.append(token)
+        elif is_shape:
+            tokens.append(random.choice(('objects', 'things')))
+    return ' '.join(tokens)
 
 # other distractor: literal but not enriched, and incorrect predicate (co-occur)?
 # Some > all vs Some < all
@@ -122,20 +139,14 @@ def template_on_DSI_some_implicature(state: str="I"):
     <second_object_name: str> <second_object_candidate_categories: List> <second_object_name_no_synonyms: List>
     """
     primary_object_name, masks, attrs, pri_candidates = sample_attr_object_under_discussion()
-    affix = random.sample([("Some ", " are "), ("There are some ", " which are "), ("It contains some ", " which are ")], 1)
+    affix = list(random.choice([("Some ", " are "), ("There are some ", " which are "), ("It contains some ", " which are ")]))
     # primary_object_name = affix[0] + primary_object_name
     
     if state == "I":
-        candidates = ['size', 'color', 'material', 'shape']
-        for i, mask in enumerate(masks):
-            if mask:
-                candidates.pop(i)
+        candidates = [c for c, m in zip(['size', 'color', 'material', 'shape'], masks) if not m]
         while len(candidates) == 0:
             primary_object_name, masks, attrs, pri_candidates = sample_attr_object_under_discussion()
-            candidates = ['size', 'color', 'material', 'shape']
-            for i, mask in enumerate(masks):
-                if mask:
-                    candidates.pop(i)
+            candidates = [c for c, m in zip(['size', 'color', 'material', 'shape'], masks) if not m]
             
         # sample among the candidates, could be 1~len(candidates) numbers of objects
         second_attrs_name, second_masks, second_attrs, sec_candidates = sample_attr_object_under_discussion(candidates, True)
@@ -150,15 +161,17 @@ def template_on_DSI_some_implicature(state: str="I"):
         # one or two utterances each game round.
         # For primary attributes, **Not** the subset of the auxiliary attributes 
         candidates = ['size', 'color', 'material', 'shape']
-        flag = True
-        overlap_attr = [] 
-        while flag:
-            second_attrs_name, second_masks, second_attrs, sec_candidates = sample_attr_object_under_discussion(candidates, True)
-            for i, attr in enumerate(second_attrs):
-                if attr not in attrs: # red objects vs red cubes. 
-                    flag = False
-                else:
-                    overlap_attr.append((i, attr))
+        primary_attrs = set(attrs or [])
+        second_attrs = None
+        while second_attrs is None:
+            # Draw a batch of masks at once and keep the first sample that is not a subset of the primary attributes.
+            batch_masks = _rng.integers(0, 2, size=(16, len(candidates)))
+            for row in batch_masks[batch_masks.any(axis=1)]:
+                second_attrs_name, second_masks, second_attrs, sec_candidates = sample_attr_object_under_discussion(candidates, True, row)
+                if not primary_attrs.issuperset(second_attrs): # red objects vs red cubes. 
+                    break
+                second_attrs = None
+        overlap_attr = [(i, attr) for i, attr in enumerate(second_attrs) if attr in primary_attrs]
         
         # Could exist several "compare" utterances simulatenously when there are overlaps
         # "Same color as" Utterances
@@ -168,38 +181,20 @@ def template_on_DSI_some_implicature(state: str="I"):
         if overlap_attr_count > 0:
             
             affix[1] = affix[1].replace("are", "have")
-            num_of_overlapped_attributes = int(np.random.choice(overlap_attr_count, 1))
-            # copy the name
-            compare_primary_name = copy.deepcopy(primary_object_name)
-            compare_second_name = copy.deepcopy(second_attributes_name)
+            num_of_overlapped_attributes = int(np.random.choice(overlap_attr_count, 1)) + 1
+            # strings are immutable, so the names can be shared directly
+            compare_primary_name = primary_object_name
+            compare_second_name = second_attrs_name
             # Set the predicate templates, such as "Same color as"
-            sampled_attributes = random.sample(overlap_attr, num_of_overlapped_attributes)    
-            temp_predicate_parameter_value = sec_candidates[overlap_attr.index(sampled_attributes[0])]
-            temp_predicate_template = f"the same {temp_predicate_parameter_value}"
-            synonym_alternatives = SYNONYMS[temp_predicate_parameter_value]
-            for synonym in synonym_alternatives:
-                if predicate_parameter_value != "shape":
-                    compare_primary_name.replace(" "+synonym, "")
-                    compare_second_name.replace(" "+synonym, "")
-                else:
-                    compare_primary_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-                    compare_second_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-            
-            
-            while len(sampled_attributes) != 0:
-                sampled_attributes.pop(0)
-                if len(sampled_attribute) != 0:
-                    temp_predicate_parameter_value = sec_candidates[overlap_attr.index(sampled_attributes[0])]
-                    temp_predicate_template += "and the same {temp_predicate_parameter_value}"
-                    synonym_alternatives = SYNONYMS[temp_predicate_parameter_value]
-                    for synonym in synonym_alternatives:
-                        if predicate_parameter_value != "shape":
-                            compare_primary_name.replace(" "+synonym, "")
-                            compare_second_name.replace(" "+synonym, "")
-                        else:
-                            compare_primary_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-                            compare_second_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-            temp_predicate_template += "as the"
+            sampled_attributes = random.sample(overlap_attr, num_of_overlapped_attributes)
+            predicates = []
+            for i, attr in sampled_attributes:
+                predicate_parameter_value = sec_candidates[i]
+                predicates.append(f"the same {predicate_parameter_value}")
+                # the shared attribute is now carried by the predicate, so drop it from both names
+                compare_primary_name = _drop_attribute_words(compare_primary_name, attr, predicate_parameter_value == "shape")
+                compare_second_name = _drop_attribute_words(compare_second_name, attr, predicate_parameter_value == "shape")
+            temp_predicate_template = f"{' and '.join(predicates)} as the "
             utterances.append(affix[0]+compare_primary_name+affix[1]+temp_predicate_template+compare_second_name)
                 
         # Start at the spatial relationships
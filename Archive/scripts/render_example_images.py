@@ -6,12 +6,11 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile, itertools
+import math, sys, random, argparse, json, os, re, tempfile, itertools, subprocess
 import os.path as osp
 from datetime import datetime as dt
 from collections import Counter
 import numpy as np
-import copy
 
 """
 Renders random scenes using Blender, each with with a random number of objects;
@@ -63,16 +62,40 @@ parser.add_argument('--render_min_bounces', default=8, type=int,
     help="The minimum number of bounces to use for rendering.")
 parser.add_argument('--render_max_bounces', default=8, type=int,
     help="The maximum number of bounces to use for rendering.")
-parser.add_argument('--render_tile_size', default=256, type=int,
+parser.add_argument('--render_tile_size', default=None, type=int,
     help="The tile size to use for rendering. This should not affect the " +
          "quality of the rendered image but may affect the speed; CPU-based " +
          "rendering may achieve better performance using smaller tile sizes " +
-         "while larger tile sizes may be optimal for GPU-based rendering.")
+         "while larger tile sizes may be optimal for GPU-based rendering. " +
+         "Use a power of two. Defaults to 32 on CPU and 256 with --use_gpu 1.")
+parser.add_argument('--render_num_chunks', default=1, type=int,
+    help="Split the sample budget of every scene across this many background " +
+         "Blender processes, each rendering render_num_samples / chunks " +
+         "samples with its own seed; the partial renders are then averaged.")
+parser.add_argument('--render_seed', default=None, type=int,
+    help="The Cycles sampling seed. Chunked renders give every chunk its own seed.")
+parser.add_argument('--chunk_index', default=-1, type=int,
+    help="Set internally for the per-chunk Blender processes. -1 means the launcher.")
+parser.add_argument('--scene_seed', default=None, type=int,
+    help="Set internally so that all chunks build exactly the same scenes.")
+parser.add_argument('--num_gpus', default=1, type=int,
+    help="The number of GPUs to render on. With more than one GPU, the scenes " +
+         "are split across one background Blender process per GPU.")
+parser.add_argument('--gpu_index', default=-1, type=int,
+    help="Set internally for the per-GPU Blender processes: the GPU (and the " +
+         "share of the scenes) this process renders. -1 means the launcher.")
+parser.add_argument('--mode', default='local', choices=['local', 'master', 'worker'],
+    help="local renders the example scenes directly. master writes them to " +
+         "--manifest and queues one file per scene in a pending/ directory next " +
+         "to it; worker claims queued scenes one at a time and renders them, so " +
+         "any number of workers can share the queue.")
+parser.add_argument('--manifest', default='./data/v3-examples/manifest.json',
+    help="The render manifest written by --mode master and read by --mode worker.")
 
 # 2x8x3x2 = 96 elements
 # utterances: <Size> <Color> <Material> <Shape> in the state of <x>
 
-INTRINSIC_PRIMITIVES = {"size": ['small', 'large'], "color": ["gray", "red", "blue", "green", "brown", "purple", "cyan", "yellow"], "shape": ["cube", "sphere", "cylinder"], "material": ["rubber", "metal"]}
+INTRINSIC_PRIMITIVES = {"size": ('small', 'large'), "color": ("gray", "red", "blue", "green", "brown", "purple", "cyan", "yellow"), "shape": ("cube", "sphere", "cylinder"), "material": ("rubber", "metal")}
 
 EXTRINSIC_PRIMITIVES = {"Relation": ["left", "right", "behind", "front"]}
 
@@ -83,27 +106,37 @@ with open('../question_generation/synonyms.json', 'r') as f:
 for color in INTRINSIC_PRIMITIVES['color']:
     SYNONYMS[color] = [color]
 
+with open('../image_generation/data/properties.json', 'r') as f:
+    _PROPERTIES = json.load(f)
+_SIZE_MAPPING = dict(_PROPERTIES['sizes'].items())
+
+# flat lookup table for drawing many attribute tuples at once
+_ATTR_VALUES = {k: np.array(v) for k, v in INTRINSIC_PRIMITIVES.items()}
+
+def sample_attr_object_batch(n: int, attr_types: list=['size', 'color', 'material', 'shape']):
+    # one list of value indices per attribute type; strings are looked up in _ATTR_VALUES only when emitted.
+    # Drawn from `random` like the rest of the sampling, so seeding it still fixes the scenes.
+    return {k: [random.randrange(len(_ATTR_VALUES[k])) for _ in range(n)] for k in attr_types}
+
 def sample_attr_object_under_discussion(candidates_: list=['size', 'color', 'material', 'shape'], 
                                            secondary: bool=False):
     # <Size> <Color> <Material> <Shape>
-    masks = np.random.choice(2,len(candidates_)).tolist()
-    
-    while 1 not in masks:
-        if secondary:
-            masks = np.random.choice(2,len(candidates_)).tolist()
-        else:
-            return random.sample(SYNONYMS['thing'], 1)[0]+"s", masks, None, candidates_
+    # one random bit per candidate attribute
+    n = len(candidates_)
+    bits = random.getrandbits(n)
+    if not bits and not secondary:
+        return random.choice(SYNONYMS['thing'])+"s", [0] * n, None, candidates_
+    # secondary objects need at least one attribute: redraw once, then fall back to the first one
+    bits = bits or random.getrandbits(n) or 1
+    masks = [(bits >> i) & 1 for i in range(n)]
     
-    candidates = copy.deepcopy(candidates_)
-    for i, mask in enumerate(masks):
-        if not mask:
-            candidates.pop(i)
+    candidates = [c for c, m in zip(candidates_, masks) if m]
     
     composed_name= []
     attribute_values = []
     for candidate in candidates:
-        attr = random.sample(INTRINSIC_PRIMITIVES[candidate], 1)[0]
-        composed_name.append(random.sample(SYNONYMS[attr], 1)[0])
+        attr = random.choice(INTRINSIC_PRIMITIVES[candidate])
+        composed_name.append(random.choice(SYNONYMS[attr]))
         attribute_values.append(attr) # different instantiations of our synonyms
         
     composed_name = ' '.join(composed_name)
@@ -111,7 +144,14 @@ def sample_attr_object_under_discussion(candidates_: list=['size', 'color', 'mat
     if 'shape' in candidates:
         return composed_name+'s', masks, attribute_values, candidates
     else:
-        return composed_name+' '+random.sample(SYNONYMS['thing'], 1)[0]+"s", masks, attribute_values, candidates
+        return composed_name+' '+random.choice(SYNONYMS['thing'])+"s", masks, attribute_values, candidates
+
+def _strip_synonyms(name: str, synonyms: list, is_shape: bool):
+    # Remove every synonym (or its plural) in a single regex pass; shape words become a generic noun instead.
+    pattern = r'\b(?:' + '|'.join(re.escape(s) for s in sorted(synonyms, key=len, reverse=True)) + r')s?\b'
+    if is_shape:
+        return re.sub(pattern, random.choice(['objects', 'things']), name)
+    return ' '.join(re.sub(pattern, '', name).split())
 
 # other distractor: literal but not enriched, and incorrect predicate (co-occur)?
 # Some > all vs Some < all
@@ -122,20 +162,14 @@ def template_on_DSI_some_implicature(state: str="I"):
     <second_object_name: str> <second_object_candidate_categories: List> <second_object_name_no_synonyms: List>
     """
     primary_object_name, masks, attrs, pri_candidates = sample_attr_object_under_discussion()
-    affix = random.sample([("Some ", " are "), ("There are some ", " which are "), ("It contains some ", " which are ")], 1)
+    affix = list(random.choice([("Some ", " are "), ("There are some ", " which are "), ("It contains some ", " which are ")]))
     # primary_object_name = affix[0] + primary_object_name
     
     if state == "I":
-        candidates = ['size', 'color', 'material', 'shape']
-        for i, mask in enumerate(masks):
-            if mask:
-                candidates.pop(i)
+        candidates = [c for c, m in zip(['size', 'color', 'material', 'shape'], masks) if not m]
         while len(candidates) == 0:
             primary_object_name, masks, attrs, pri_candidates = sample_attr_object_under_discussion()
-            candidates = ['size', 'color', 'material', 'shape']
-            for i, mask in enumerate(masks):
-                if mask:
-                    candidates.pop(i)
+            candidates = [c for c, m in zip(['size', 'color', 'material', 'shape'], masks) if not m]
             
         # sample among the candidates, could be 1~len(candidates) numbers of objects
         second_attrs_name, second_masks, second_attrs, sec_candidates = sample_attr_object_under_discussion(candidates, True)
@@ -168,50 +202,39 @@ def template_on_DSI_some_implicature(state: str="I"):
         if overlap_attr_count > 0:
             
             affix[1] = affix[1].replace("are", "have")
-            num_of_overlapped_attributes = int(np.random.choice(overlap_attr_count, 1))
-            # copy the name
-            compare_primary_name = copy.deepcopy(primary_object_name)
-            compare_second_name = copy.deepcopy(second_attributes_name)
+            num_of_overlapped_attributes = random.randrange(overlap_attr_count) + 1
+            # strings are immutable, so the names can be shared directly
+            compare_primary_name = primary_object_name
+            compare_second_name = second_attrs_name
             # Set the predicate templates, such as "Same color as"
-            sampled_attributes = random.sample(overlap_attr, num_of_overlapped_attributes)    
-            temp_predicate_parameter_value = sec_candidates[overlap_attr.index(sampled_attributes[0])]
-            temp_predicate_template = f"the same {temp_predicate_parameter_value}"
-            synonym_alternatives = SYNONYMS[temp_predicate_parameter_value]
-            for synonym in synonym_alternatives:
-                if predicate_parameter_value != "shape":
-                    compare_primary_name.replace(" "+synonym, "")
-                    compare_second_name.replace(" "+synonym, "")
-                else:
-                    compare_primary_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-                    compare_second_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-            
-            
+            sampled_attributes = random.sample(overlap_attr, num_of_overlapped_attributes)
+            temp_predicate_template = ""
             while len(sampled_attributes) != 0:
-                sampled_attributes.pop(0)
-                if len(sampled_attribute) != 0:
-                    temp_predicate_parameter_value = sec_candidates[overlap_attr.index(sampled_attributes[0])]
-                    temp_predicate_template += "and the same {temp_predicate_parameter_value}"
-                    synonym_alternatives = SYNONYMS[temp_predicate_parameter_value]
-                    for synonym in synonym_alternatives:
-                        if predicate_parameter_value != "shape":
-                            compare_primary_name.replace(" "+synonym, "")
-                            compare_second_name.replace(" "+synonym, "")
-                        else:
-                            compare_primary_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-                            compare_second_name.replace(" "+synonym, random.sample(['objects', 'things'], 1)[0])
-            temp_predicate_template += "as the"
+                attr_index, attr = sampled_attributes.pop(0)
+                temp_predicate_parameter_value = sec_candidates[attr_index]
+                if temp_predicate_template:
+                    temp_predicate_template += " and "
+                temp_predicate_template += f"the same {temp_predicate_parameter_value}"
+                # the shared attribute is carried by the predicate, so drop its words from both names
+                synonym_alternatives = SYNONYMS.get(attr, [attr])
+                is_shape = temp_predicate_parameter_value == "shape"
+                compare_primary_name = _strip_synonyms(compare_primary_name, synonym_alternatives, is_shape)
+                compare_second_name = _strip_synonyms(compare_second_name, synonym_alternatives, is_shape)
+            temp_predicate_template += " as the "
             utterances.append(affix[0]+compare_primary_name+affix[1]+temp_predicate_template+compare_second_name)
                 
         # Start at the spatial relationships
         # TODO
 def position_enable_partial_occlusion(args, positions: list[tuple], blender_objects: list, intended_object_size: str = "small"):
     # measure one object per run
-    with open('../image_generation/data/properties.json', 'r') as f:
-        properties = json.load(f)
-        size_mapping = list(properties['sizes'].items())
-    r = size_mapping[intended_object_size]
+    r = _SIZE_MAPPING[intended_object_size]
     
-    positions = copy.deepcopy(positions)
+    positions = list(positions)
+    positions_arr = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    # the four cardinal directions as a (4, 2) matrix; they lie in the ground plane
+    directions = np.array([scene_struct['directions'][d] for d in ('left', 'right', 'front', 'behind')], dtype=np.float64)
+    assert np.all(directions[:, 2] == 0)
+    directions = directions[:, :2]
     
     num_tries = 0
     while True:
@@ -225,26 +248,13 @@ def position_enable_partial_occlusion(args, positions: list[tuple], blender_obje
         x = random.uniform(-3, 3)
         y = random.uniform(-3, 3)
         # Check to make sure the new object is further than min_dist from all
-        # other objects, and further than margin along the four cardinal directions
-        dists_good = True
-        margins_good = True
-        for (xx, yy, rr) in positions:
-            dx, dy = x - xx, y - yy
-            dist = math.sqrt(dx * dx + dy * dy)
-            if dist - r - rr < args.min_dist:
-                dists_good = False
-                break
-            for direction_name in ['left', 'right', 'front', 'behind']:
-                direction_vec = scene_struct['directions'][direction_name]
-                assert direction_vec[2] == 0
-                margin = dx * direction_vec[0] + dy * direction_vec[1]
-                if 0 < margin < args.margin:
-                    print(margin, args.margin, direction_name)
-                    print('BROKEN MARGIN!')
-                    margins_good = False
-                    break
-            if not margins_good:
-                break
+        # other objects, and further than margin along the four cardinal directions.
+        # All placed objects are tested at once on the (N, 3) array of (x, y, r).
+        dxdy = np.array([x, y]) - positions_arr[:, :2]
+        d2 = np.einsum('ij,ij->i', dxdy, dxdy)
+        dists_good = np.all(d2 >= (args.min_dist + r + positions_arr[:, 2]) ** 2)
+        margins = dxdy @ directions.T
+        margins_good = not np.any((margins > 0) & (margins < args.margin))
         if dists_good and margins_good:
             break
     
@@ -271,18 +281,22 @@ def add_pre_objects(args, attr_values: list, attr_types: list, objects_list: lis
     positions = []
     generated_count = 0
     
-    objects_list_copy = copy.deepcopy(objects_list)
+    objects_list_copy = list(objects_list)
     
-    num_main = int(np.random.choice(count, 1)) + 1
+    num_main = random.randrange(count) + 1
     
     if not no_more_flag:
         # Otherwise, adding some random objects
         num_random = count - num_main
-        included_intrinsic_primitives = copy.deepcopy(INTRINSIC_PRIMITIVES)
-        for i, exclude_attr_type in excluded_random_attr_types:
-            included_intrinsic_primitives[exclude_attr_type].pop(included_intrinsic_primitives[exclude_attr_type].index(excluded_random_attr_values[i]))
+        included_intrinsic_primitives = {k: list(v) for k, v in INTRINSIC_PRIMITIVES.items()}
+        for i, exclude_attr_type in enumerate(excluded_random_attr_types):
+            included_intrinsic_primitives[exclude_attr_type] = [
+                x for x in included_intrinsic_primitives[exclude_attr_type] if x != excluded_random_attr_values[i]
+            ]
             
             
+    # draw the free attributes of every main object up front
+    sampled = sample_attr_object_batch(num_main, unset_attrs)
     while generated_count != num_main:
         while len(positions) == 0:
             added_object = {}
@@ -290,7 +304,7 @@ def add_pre_objects(args, attr_values: list, attr_types: list, objects_list: lis
                 added_object[attr_type] = attr_values[i]
 
             for attr_type in unset_attrs:
-                added_object[attr_type] = random.sample(INTRINSIC_PRIMITIVES[attr_type], 1)[0]
+                added_object[attr_type] = str(_ATTR_VALUES[attr_type][sampled[attr_type][generated_count]])
                 if attr_type == 'size': 
                     intended_object_size = added_object[attr_type]
 
@@ -298,6 +312,8 @@ def add_pre_objects(args, attr_values: list, attr_types: list, objects_list: lis
             if not positions: # check visibility out of this function
                 generated_count = 0
                 objects_list = objects_list_copy
+                # the drawn attributes may be why the placement failed (e.g. a large object), so draw new ones
+                sampled = sample_attr_object_batch(num_main, unset_attrs)
                 continue
             generated_count += 1
             added_object['pos'] = (positions[-1][0], positions[-1][1])
@@ -341,7 +357,7 @@ def images_on_DSI_some_implicature(state: str="I", cancel: bool=False, group: st
         # distractor by literal grounding: all <obj> are <state1>
         if not attrs:
             # template: all objects are xxx, attrs: second_attrs
-            total_count = random.sample([3, 4], 1)[0]
+            total_count = random.choice([3, 4])
             scene = add_pre_objects(second_attrs, sec_candidates, [], total_count, no_more_flag, group)
             
         
@@ -353,146 +369,229 @@ def images_on_DSI_some_implicature(state: str="I", cancel: bool=False, group: st
     
     
 
+# The example scenes are fixed. Objects are placed on a 3x3 grid, where cell k
+# sits at (-3 + 3 * (k // 3), -5 + 4.5 * (k % 3)); the positions below are
+# precomputed from that formula (minus the per-object offsets).
+_SCENE1 = {'objects': [
+    {'color': 'red', 'shape': 'sphere', 'material': 'metal', 'size': 'small', 'pos': (-3, -5.0)},  # k = 0
+    {'color': 'red', 'shape': 'sphere', 'material': 'metal', 'size': 'small', 'pos': (-3, 4.0)},  # k = 2
+    {'color': 'red', 'shape': 'sphere', 'material': 'metal', 'size': 'large', 'pos': (3, -0.5)},  # k = 7
+]}
+
+_SCENE2 = {'objects': [
+    {'color': 'red', 'shape': 'sphere', 'material': 'metal', 'size': 'large', 'pos': (-3, -5.0)},  # k = 0
+    # x: -3 left corner, y: k=2 up right corner
+    {'color': 'green', 'shape': 'sphere', 'material': 'metal', 'size': 'large', 'pos': (-2.5, 1)},
+    {'color': 'red', 'shape': 'sphere', 'material': 'metal', 'size': 'large', 'pos': (3, -1.5)},  # k = 7, dis = -1
+    {'color': 'blue', 'shape': 'cube', 'material': 'metal', 'size': 'large', 'pos': (3, 0.5)},  # k = 7, dis = +1
+]}
+
+_SCENE3 = {'objects': [
+    {'color': 'red', 'shape': 'cube', 'material': 'metal', 'size': 'large', 'pos': (-3, -5.0)},  # k = 0
+    {'color': 'red', 'shape': 'cube', 'material': 'metal', 'size': 'small', 'pos': (-3, 4.0)},  # k = 2
+    {'color': 'red', 'shape': 'cube', 'material': 'metal', 'size': 'large', 'pos': (3, -1.5)},  # k = 7, dis = -1
+    {'color': 'blue', 'shape': 'cube', 'material': 'metal', 'size': 'large', 'pos': (3, 0.5)},  # k = 7, dis = +1
+]}
+
+
+# render_scene only reads the specs, so the constants are returned as they are.
 def gen_scene1():
-    rv = []
-
-    dis = 0
-    k = 0
-    rv.append({
-        'color': 'red',
-        'shape': 'sphere',
-        'material': 'metal',
-        'size': 'small', #RSA_SCENE_SPEC_SIZE[2],
-        'pos': (-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis)
-    })
-    k = 2
-    rv.append({
-        'color': 'red',
-        'shape': 'sphere',
-        'material': 'metal',
-        'size': 'small', #RSA_SCENE_SPEC_SIZE[2],
-        'pos': (-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis)
-    })
-    k = 7
-    rv.append({
-        'color': 'red',
-        'shape': 'sphere',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis)
-    })
-    return {'objects': rv}
+    return _SCENE1
+
 
 def gen_scene2():
-    rv = []
-
-    dis = 0
-    k = 0
-    rv.append({
-        'color': 'red',
-        'shape': 'sphere',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis)
-    })
-    k = 0.5
-    rv.append({
-        'color': 'green',
-        'shape': 'sphere',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[2],
-        'pos': (-2.5, 1)#-5 + 4.5 * (k % 3) - dis) #(-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis) # x: -3 left corner, y: k=2 up right corner
-    })
-    k = 7
-    dis = 1
-    rv.append({
-        'color': 'red',
-        'shape': 'sphere',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3), -5 + 4.5 * (k % 3) - dis)
-    })
-    rv.append({
-        'color': 'blue',
-        'shape': 'cube',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3), -5 + 4.5 * (k % 3) + dis)
-    })
-    return {'objects': rv}
+    return _SCENE2
 
 
 def gen_scene3():
-    rv = []
-
-    dis = 0
-    k = 0
-    rv.append({
-        'color': 'red',
-        'shape': 'cube',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis)
-    })
-    k = 2
-    rv.append({
-        'color': 'red',
-        'shape': 'cube',
-        'material': 'metal',
-        'size': 'small', #RSA_SCENE_SPEC_SIZE[2],
-        'pos': (-3 + 3 * (k // 3) - dis, -5 + 4.5 * (k % 3) - dis)
-    })
-    k = 7
-    dis = 1
-    rv.append({
-        'color': 'red',
-        'shape': 'cube',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3), -5 + 4.5 * (k % 3) - dis)
-    })
-    rv.append({
-        'color': 'blue',
-        'shape': 'cube',
-        'material': 'metal',
-        'size': 'large', #RSA_SCENE_SPEC_SIZE[4],
-        'pos': (-3 + 3 * (k // 3), -5 + 4.5 * (k % 3) + dis)
-    })
-    return {'objects': rv}
+    return _SCENE3
+
+
+# Output paths of the example scenes; %% is replaced by the scene index.
+SCENE_OUTPUTS = {
+    'output_image': './data/v3-examples/images/scene_example%%.png',
+    'output_json': './data/v3-examples/render_jsons/scene_example%%.render.json',
+    # 'output_blendfile': './dumps/rsa_vagueness/scene_example%%.blend',
+    'output_shadeless': './data/v3-examples/images/scene_example%%.shadeless.png',
+}
+
+
+def get_scene_jobs():
+    """
+    Return a list of (spec, outputs) pairs, one per example scene, where outputs
+    holds the keyword arguments for render_scene.
+    """
+    jobs = []
+    for index, gen_scene in enumerate([gen_scene1, gen_scene2, gen_scene3], start=1):
+        outputs = {k: v.replace('%%', str(index)) for k, v in SCENE_OUTPUTS.items()}
+        jobs.append((gen_scene(), outputs))
+    return jobs
+
+
+def launch_gpu_workers(args):
+    """
+    Re-run this script in one background Blender process per GPU. Each process
+    only sees its own GPU and renders every num_gpus-th scene, so the renders
+    run in parallel without sharing a Cycles device.
+    """
+    argv = utils.extract_args()
+    processes = []
+    for gpu_index in range(args.num_gpus):
+        env = os.environ.copy()
+        env['CUDA_VISIBLE_DEVICES'] = str(gpu_index)
+        cmd = [bpy.app.binary_path, '--background', '--python', osp.abspath(__file__), '--']
+        cmd += argv + ['--gpu_index', str(gpu_index)]
+        processes.append(subprocess.Popen(cmd, env=env))
+    returncodes = [process.wait() for process in processes]
+    failed = [gpu_index for gpu_index, code in enumerate(returncodes) if code != 0]
+    if failed:
+        raise RuntimeError('GPU workers %s exited with an error' % failed)
+
+
+def get_queue_dirs(manifest):
+    """The pending/, claimed/ and done/ directories of the queue next to the manifest."""
+    root = osp.dirname(osp.abspath(manifest))
+    return tuple(osp.join(root, name) for name in ('pending', 'claimed', 'done'))
+
+
+def write_manifest(args):
+    """
+    Write every scene job to the manifest, and queue each of them as its own
+    file in pending/ for the workers to claim.
+    """
+    jobs = [{'spec': spec, 'outputs': outputs} for spec, outputs in get_scene_jobs()]
+    with open(args.manifest, 'w') as f:
+        json.dump(jobs, f, indent=2)
+
+    pending_dir, claimed_dir, done_dir = get_queue_dirs(args.manifest)
+    for d in (pending_dir, claimed_dir, done_dir):
+        os.makedirs(d, exist_ok=True)
+    for index, job in enumerate(jobs):
+        with open(osp.join(pending_dir, '%06d.json' % index), 'w') as f:
+            json.dump(job, f)
+    print('Queued {} scenes in {}.'.format(len(jobs), pending_dir))
+
+
+def run_worker(args):
+    """
+    Render queued scenes until pending/ is empty. A job is claimed by renaming
+    it into claimed/; the rename is atomic, so only one worker can win it.
+    """
+    pending_dir, claimed_dir, done_dir = get_queue_dirs(args.manifest)
+    while True:
+        names = sorted(os.listdir(pending_dir))
+        if len(names) == 0:
+            break
+        for name in names:
+            claimed = osp.join(claimed_dir, name)
+            try:
+                os.rename(osp.join(pending_dir, name), claimed)
+            except OSError:
+                # another worker was faster
+                continue
+            with open(claimed) as f:
+                job = json.load(f)
+            render_scene(args, job['spec'], **job['outputs'])
+            os.rename(claimed, osp.join(done_dir, name))
 
 
 def main(args):
+    if args.render_tile_size is None:
+        # Small tiles keep every CPU thread busy; the GPU needs large tiles to fill up.
+        args.render_tile_size = 256 if args.use_gpu == 1 else 32
+
     import os
     os.makedirs('./data/v3-examples/images', exist_ok=True)
     os.makedirs('./data/v3-examples/render_jsons', exist_ok=True)
 
-    spec = gen_scene1()
-    print(spec)
-    render_scene(args,
-         spec,
-         output_image='./data/v3-examples/images/scene_example1.png',
-         output_json='./data/v3-examples/render_jsons/scene_example1.render.json',
-         # output_blendfile='./dumps/rsa_vagueness/scene_example1.blend',
-         output_shadeless='./data/v3-examples/images/scene_example1.shadeless.png'
-    )
-    spec = gen_scene2()
-    print(spec)
-    render_scene(args,
-        spec,
-        output_image='./data/v3-examples/images/scene_example2.png',
-        output_json='./data/v3-examples/render_jsons/scene_example2.render.json',
-        # output_blendfile='./dumps/rsa_vagueness/scene_example2.blend',
-        output_shadeless='./data/v3-examples/images/scene_example2.shadeless.png'
-    )
-    spec = gen_scene3()
-    print(spec)
-    render_scene(args,
-        spec,
-        output_image='./data/v3-examples/images/scene_example3.png',
-        output_json='./data/v3-examples/render_jsons/scene_example3.render.json',
-        # output_blendfile='./dumps/rsa_vagueness/scene_example3.blend',
-        output_shadeless='./data/v3-examples/images/scene_example3.shadeless.png'
-    )
+    if args.mode == 'master':
+        write_manifest(args)
+        return
+    if args.mode == 'worker':
+        run_worker(args)
+        return
+
+    if args.num_gpus > 1 and args.gpu_index < 0:
+        launch_gpu_workers(args)
+        return
+
+    jobs = get_scene_jobs()
+    if args.gpu_index >= 0:
+        jobs = jobs[args.gpu_index::args.num_gpus]
+
+    if args.render_num_chunks > 1 and args.chunk_index < 0:
+        render_chunked(args, jobs)
+        return
+
+    if args.scene_seed is not None:
+        random.seed(args.scene_seed)
+
+    for spec, outputs in jobs:
+        print(spec)
+        if args.chunk_index >= 0:
+            outputs = get_chunk_outputs(outputs, args.chunk_index)
+        render_scene(args, spec, **outputs)
+
+
+def get_chunk_outputs(outputs, chunk_index):
+    """
+    The outputs of one chunk: the image goes to scene_exampleN.partK.png, and
+    only the first chunk writes the json and the shadeless image.
+    """
+    chunk_outputs = {k: (v if chunk_index == 0 else None) for k, v in outputs.items()}
+    chunk_outputs['output_image'] = outputs['output_image'].replace('.png', '.part%d.png' % chunk_index)
+    return chunk_outputs
+
+
+def render_chunked(args, jobs):
+    """
+    Render every scene in render_num_chunks background Blender processes, each
+    using 1/chunks of the samples and a different seed, and average the parts.
+    All chunks share a scene seed so that they build exactly the same scene.
+    """
+    argv = utils.extract_args()
+    scene_seed = random.randrange(2 ** 31)
+    num_samples = max(args.render_num_samples // args.render_num_chunks, 1)
+    processes = []
+    for chunk_index in range(args.render_num_chunks):
+        cmd = [bpy.app.binary_path, '--background', '--python', osp.abspath(__file__), '--']
+        cmd += argv + [
+            '--render_num_samples', str(num_samples), '--render_seed', str(chunk_index),
+            '--chunk_index', str(chunk_index), '--scene_seed', str(scene_seed)
+        ]
+        processes.append(subprocess.Popen(cmd))
+    returncodes = [process.wait() for process in processes]
+    failed = [chunk_index for chunk_index, code in enumerate(returncodes) if code != 0]
+    if failed:
+        raise RuntimeError('render chunks %s exited with an error' % failed)
+
+    for spec, outputs in jobs:
+        parts = [get_chunk_outputs(outputs, k)['output_image'] for k in range(args.render_num_chunks)]
+        missing = [part for part in parts if not osp.exists(part)]
+        if missing:
+            print('Skipping %s, missing chunk images %s' % (outputs['output_image'], missing))
+        else:
+            average_images(parts, outputs['output_image'])
+        for part in parts:
+            if part not in missing:
+                os.remove(part)
+
+
+def average_images(paths, output_path):
+    """Average the images at paths pixel-wise and save the result as a PNG."""
+    pixels = []
+    for path in paths:
+        image = bpy.data.images.load(path)
+        width, height = image.size
+        pixels.append(np.array(image.pixels[:], dtype=np.float32))
+        bpy.data.images.remove(image)
+
+    result = bpy.data.images.new('chunk_average', width=width, height=height, alpha=True)
+    result.pixels[:] = np.mean(np.stack(pixels), axis=0).tolist()
+    result.filepath_raw = output_path
+    result.file_format = 'PNG'
+    result.save()
+    bpy.data.images.remove(result)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,40 @@
 import cv2
 import pycocotools
-from pycocotools.mask import decode
+try:
+    from faster_coco_eval.core.mask import decode
+except ImportError:
+    from pycocotools.mask import decode
 import argparse
+import logging
 import os
+import sys
 import json
+import hashlib
+import importlib.util
+import mmap
 import numpy as np
+import numba
+import matplotlib.cm
+from collections import OrderedDict, deque
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+try:
+    import pyspng
+except ImportError:
+    pyspng = None
+try:
+    import fpng
+except ImportError:
+    fpng = None
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, lru_cache
+from operator import itemgetter
 
 parser = argparse.ArgumentParser()
 # Input options
@@ -120,12 +150,232 @@ parser.add_argument('--render_tile_size', default=256, type=int,
          "quality of the rendered image but may affect the speed; CPU-based " +
          "rendering may achieve better performance using smaller tile sizes " +
          "while larger tile sizes may be optimal for GPU-based rendering.")
+parser.add_argument('--workers', default=os.cpu_count(), type=int,
+    help="The number of processes that tag images in parallel. Each worker " +
+         "runs OpenCV, BLAS and numba single-threaded; use --workers 1 to " +
+         "tag in one process with all threads instead.")
+parser.add_argument('--decode_bg', default='full', choices=['full', 'half', 'none'],
+    help="How to load the rendered image under the marks: full decodes it, " +
+         "half decodes it at half resolution and tags at that size, and none " +
+         "skips the decode and draws the marks on a black canvas.")
+parser.add_argument('--fast_render', default=1, type=int,
+    help="Setting --fast_render 1 draws the marks with NumPy and OpenCV; " +
+         "--fast_render 0 draws them with the SoM Visualizer.")
+parser.add_argument('--out_ext', default='png', choices=['png', 'jpg'],
+    help="Format of the tagged images: png (zlib level 1) or jpg (quality 90).")
+parser.add_argument('--scene_bundle', default=None,
+    help="Optional path to a single JSON file holding all --num_images scenes, " +
+         "with the byte range of each scene in <scene_bundle>.index. Workers " +
+         "map it and parse only the scenes they tag instead of opening one " +
+         "file per image. It is rebuilt when --start_idx or --num_images " +
+         "change or when a scene file is newer than it, e.g. after a run " +
+         "wrote referent ids back to the scene files.")
+parser.add_argument('--verbose', action='store_true',
+    help="Log the referent id, utterance, referent and output path of every image.")
+parser.add_argument('--cache', default=0, type=int,
+    help="Setting --cache 1 skips images whose tagged output is up to date: " +
+         "a .key file next to each output records the scene, the rendered " +
+         "image's mtime and the drawing options it was made from.")
+
+log = logging.getLogger(__name__)
 
 from SoM.task_adapter.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog
-metadata = MetadataCatalog.get('coco_2017_train_panoptic')
+metadata = None
+_visualizer = None
+_bundle = None
 
-def main(args):
+def _init_worker(single_threaded=False, args=None):
+    # fetch the metadata once per process instead of once per image
+    global metadata, _bundle
+    metadata = MetadataCatalog.get('coco_2017_train_panoptic')
+    if args is not None and args.scene_bundle is not None:
+        _bundle = load_scene_bundle(args)
+    if single_threaded:
+        # the pool already uses every core; inner thread pools would only oversubscribe them
+        cv2.setNumThreads(1)
+        numba.set_num_threads(1)
+
+class ReusableVisualizer(Visualizer):
+    """
+    A Visualizer that can be pointed at a new image, keeping its matplotlib
+    figure and canvas instead of building new ones for every image.
+    """
+    def reset(self, img):
+        if img.dtype != np.uint8:
+            img = np.asarray(img).clip(0, 255).astype(np.uint8)
+        if img.shape[:2] != self.img.shape[:2]:
+            # the figure is sized to the image, so a new size needs a new one
+            self.__init__(img, metadata=self.metadata)
+            return self
+        self.img = img
+        self.output.img = img
+        self.output.ax.cla()
+        self.output.ax.axis("off")
+        self.output.reset_image(img)
+        return self
+
+def get_visualizer(image):
+    # one visualizer per worker process, reset for every image
+    global _visualizer
+    if _visualizer is None:
+        _visualizer = ReusableVisualizer(image, metadata=metadata)
+        return _visualizer
+    return _visualizer.reset(image)
+
+# decoded masks by RLE content, least recently used first; ~77KB per 320x240 mask
+_mask_cache = OrderedDict()
+_MASK_CACHE_SIZE = 512
+
+def _rle_key(rle):
+    counts = rle['counts']
+    if isinstance(counts, str):
+        counts = counts.encode()
+    return hashlib.blake2b(counts + bytes(str(rle['size']), 'ascii'), digest_size=16).digest()
+
+def decode_masks(rles):
+    """
+    Decode a list of RLEs into an H x W x N stack. Masks seen before are taken
+    from the cache; the others are decoded together in one call.
+    """
+    keys = [_rle_key(rle) for rle in rles]
+    missing = {}
+    for key, rle in zip(keys, rles):
+        if key not in _mask_cache and key not in missing:
+            missing[key] = rle
+    if missing:
+        decoded = decode(list(missing.values()))
+        for k, key in enumerate(missing):
+            _mask_cache[key] = np.ascontiguousarray(decoded[:, :, k])
+    for key in keys:
+        _mask_cache.move_to_end(key)
+    masks = np.stack([_mask_cache[key] for key in keys], axis=2)
+    while len(_mask_cache) > _MASK_CACHE_SIZE:
+        _mask_cache.popitem(last=False)
+    return masks
+
+# fixed mark colors, the tab20 palette in BGR like the images read by cv2; both
+# drawing paths use them, so the outputs are deterministic across runs
+_MARK_COLORS = (np.array(matplotlib.cm.tab20.colors)[:, ::-1] * 255).astype(np.float32)
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _composite_kernel(img, masks, colors, alpha, sums):
+    # One pass over the pixels: blend the topmost (last) mask's color and
+    # accumulate per-row (count, sum y, sum x) of every mask for the centroids.
+    H, W, N = masks.shape
+    for y in numba.prange(H):
+        for x in range(W):
+            top = -1
+            for k in range(N):
+                if masks[y, x, k]:
+                    top = k
+                    sums[y, k, 0] += 1
+                    sums[y, k, 1] += y
+                    sums[y, k, 2] += x
+            if top >= 0:
+                for c in range(3):
+                    img[y, x, c] = np.uint8(img[y, x, c] * (1 - alpha) + colors[top, c] * alpha)
+
+# the specialized kernels are generated into real files, since numba can only
+# cache the machine code of functions that have a source file
+_KERNEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'composite_kernels')
+
+@lru_cache(maxsize=None)
+def _make_composite_kernel(num_masks):
+    """
+    Build _composite_kernel specialized for exactly num_masks masks, with the
+    loop over the masks unrolled so that its trip count is a constant.
+    """
+    lines = [
+        'import numba',
+        'import numpy as np',
+        '',
+        '@numba.njit(parallel=True, fastmath=True, cache=True)',
+        'def _composite(img, masks, colors, alpha, sums):',
+        '    H, W = masks.shape[0], masks.shape[1]',
+        '    for y in numba.prange(H):',
+        '        for x in range(W):',
+        '            top = -1',
+    ]
+    for k in range(num_masks):
+        lines += [
+            '            if masks[y, x, %d]:' % k,
+            '                top = %d' % k,
+            '                sums[y, %d, 0] += 1' % k,
+            '                sums[y, %d, 1] += y' % k,
+            '                sums[y, %d, 2] += x' % k,
+        ]
+    lines += [
+        '            if top >= 0:',
+        '                for c in range(3):',
+        '                    img[y, x, c] = np.uint8(img[y, x, c] * (1 - alpha) + colors[top, c] * alpha)',
+    ]
+    source = '\n'.join(lines) + '\n'
+    name = '_composite_%d' % num_masks
+    path = os.path.join(_KERNEL_DIR, name + '.py')
+    old_source = None
+    if os.path.exists(path):
+        with open(path) as f:
+            old_source = f.read()
+    if old_source != source:
+        # numba's cache is keyed on the file's mtime, so it is only rewritten when it changes
+        os.makedirs(_KERNEL_DIR, exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(source)
+        os.replace(tmp, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # numba re-imports the module by name when it loads the cached kernel
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module._composite
+
+def draw_marks(image, masks, alpha=0.02, max_objects=None):
+    """
+    Alpha-blend the masks onto a copy of image and write each number at its
+    mask centroid; the NumPy/OpenCV counterpart of draw_binary_mask_with_number.
+    With max_objects, the masks are zero-padded to that many and composited
+    by a kernel specialized for it.
+    """
+    image = np.ascontiguousarray(image).copy()
+    kernel = _composite_kernel
+    if max_objects is not None and masks.shape[2] <= max_objects:
+        kernel = _make_composite_kernel(max_objects)
+        padding = max_objects - masks.shape[2]
+        masks = np.concatenate([masks, np.zeros(masks.shape[:2] + (padding, ), masks.dtype)], axis=2)
+    num_masks = masks.shape[2]
+    colors = _MARK_COLORS[np.arange(num_masks) % len(_MARK_COLORS)]
+    sums = np.zeros((masks.shape[0], num_masks, 3), np.float64)
+    kernel(image, np.ascontiguousarray(masks), colors, np.float32(alpha), sums)
+    count, sum_y, sum_x = sums.sum(axis=0).T
+    for k in np.flatnonzero(count):
+        cx, cy = int(sum_x[k] / count[k]), int(sum_y[k] / count[k])
+        cv2.putText(image, str(k + 1), (cx, cy), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2, cv2.LINE_AA)
+    return image
+
+def draw_marks_gpu(image, masks, alpha=0.02):
+    """
+    The CuPy counterpart of draw_marks: blend the topmost mask's color and
+    compute the mask centroids on the GPU, then write the numbers on the host.
+    """
+    num_masks = masks.shape[2]
+    masks_d = cp.asarray(masks).astype(bool)
+    img_d = cp.asarray(image).astype(cp.float32)
+    colors_d = cp.asarray(_MARK_COLORS[np.arange(num_masks) % len(_MARK_COLORS)])
+    covered = masks_d.any(axis=2)
+    top = num_masks - 1 - cp.argmax(masks_d[:, :, ::-1], axis=2)
+    blended = img_d * (1 - alpha) + colors_d[top] * alpha
+    image = cp.asnumpy(cp.where(covered[:, :, None], blended, img_d).astype(cp.uint8))
+    count = cp.asnumpy(masks_d.sum(axis=(0, 1)))
+    sum_y = cp.asnumpy((masks_d * cp.arange(masks.shape[0])[:, None, None]).sum(axis=(0, 1)))
+    sum_x = cp.asnumpy((masks_d * cp.arange(masks.shape[1])[None, :, None]).sum(axis=(0, 1)))
+    for k in np.flatnonzero(count):
+        cx, cy = int(sum_x[k] / count[k]), int(sum_y[k] / count[k])
+        cv2.putText(image, str(k + 1), (cx, cy), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2, cv2.LINE_AA)
+    return image
+
+def get_templates(args):
     prefix = '%s_%s_' % (args.filename_prefix, args.split)
     
     img_template = 'ad_hoc_%s%%0%dd.png' % (prefix, 6)
@@ -139,53 +389,235 @@ def main(args):
     
     scene_template = 'ad_hoc_%s%%0%dd.json' % (prefix, 6)
     scene_template = os.path.join(args.output_scene_dir, scene_template)
-    
-    class MyEncoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, bytes):
-                return str(obj, encoding='utf-8')
-            return json.JSONEncoder.default(self, obj)
-        
+    return img_template, mask_template, out_img_template, scene_template
+
+def cache_key(scene_struct, img_path, args):
+    data = orjson.dumps(scene_struct)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    mtime = os.path.getmtime(img_path) if os.path.exists(img_path) else 0
+    options = '%r|%s|%d|%s' % (mtime, args.decode_bg, args.fast_render, args.out_ext)
+    return hashlib.blake2b(data + options.encode('utf-8'), digest_size=8).hexdigest()
+
+def is_cached(out_img_path, key):
+    if not os.path.exists(out_img_path) or not os.path.exists(out_img_path + '.key'):
+        return False
+    with open(out_img_path + '.key') as f:
+        return f.read() == key
+
+def _read_bundle_index(args):
+    with open(args.scene_bundle + '.index', 'rb') as f:
+        return orjson.loads(f.read())
+
+def build_scene_bundle(args):
+    """
+    Concatenate the scene files of all images into one JSON list; the raw
+    bytes are joined as they are, so nothing is parsed here. The index next
+    to it records the image range and the byte range of every scene.
+    """
+    scene_template = get_templates(args)[3]
+    parts = []
+    offsets = []
+    pos = 1
     for i in range(args.num_images):
-        img_path = img_template % (i + args.start_idx)
-        out_img_path = out_img_template % (i + args.start_idx)
-        scene_path = scene_template % (i + args.start_idx)
-        mask_path = mask_template % (i + args.start_idx)
-        
-        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        with open(scene_template % (i + args.start_idx), 'rb') as f:
+            parts.append(f.read())
+        offsets.append((pos, pos + len(parts[-1])))
+        pos += len(parts[-1]) + 1
+    data = b'[' + b','.join(parts) + b']'
+    index = {'start_idx': args.start_idx, 'num_images': args.num_images,
+             'size': len(data), 'offsets': offsets}
+    for path, payload in ((args.scene_bundle, data), (args.scene_bundle + '.index', json.dumps(index).encode('ascii'))):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+
+def scene_bundle_is_stale(args):
+    """
+    Whether the bundle is missing, was built for other images, or is older
+    than one of its scene files.
+    """
+    if not os.path.exists(args.scene_bundle) or not os.path.exists(args.scene_bundle + '.index'):
+        return True
+    index = _read_bundle_index(args)
+    if (index['start_idx'], index['num_images'], index['size']) != \
+            (args.start_idx, args.num_images, os.path.getsize(args.scene_bundle)):
+        return True
+    built = os.stat(args.scene_bundle).st_mtime_ns
+    scene_template = get_templates(args)[3]
+    return any(os.stat(scene_template % (i + args.start_idx)).st_mtime_ns > built
+               for i in range(args.num_images))
+
+def load_scene_bundle(args):
+    """
+    Map the bundle and read its index; nothing is parsed until load_one takes
+    the slice of one scene.
+    """
+    index = _read_bundle_index(args)
+    if (index['start_idx'], index['num_images']) != (args.start_idx, args.num_images):
+        raise ValueError('%s holds images %d-%d, not %d-%d; rebuild it' % (
+            args.scene_bundle, index['start_idx'], index['start_idx'] + index['num_images'] - 1,
+            args.start_idx, args.start_idx + args.num_images - 1))
+    with open(args.scene_bundle, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return buf, index['offsets']
+
+def load_one(i, args):
+    """
+    Read the background image and the scene of image i. Return None when
+    --cache is on and the tagged output is already up to date.
+    """
+    img_template, mask_template, out_img_template, scene_template = get_templates(args)
+    img_path = img_template % (i + args.start_idx)
+    out_img_path = out_img_template % (i + args.start_idx)
+    if args.out_ext == 'jpg':
+        out_img_path = out_img_path[:-len('.png')] + '.jpg'
+    scene_path = scene_template % (i + args.start_idx)
+    
+    if _bundle is not None:
+        buf, offsets = _bundle
+        start, end = offsets[i]
+        scene_struct = orjson.loads(buf[start:end])
+    else:
+        with open(scene_path, "rb") as f:
+            scene_struct = orjson.loads(f.read())
+    if args.cache and is_cached(out_img_path, cache_key(scene_struct, img_path, args)):
+        return None
+    
+    if args.decode_bg == 'none':
+        image = np.zeros((args.height, args.width, 3), np.uint8)
+    elif args.decode_bg == 'half':
+        image = cv2.imread(img_path, cv2.IMREAD_REDUCED_COLOR_2)
+    elif pyspng is not None:
+        with open(img_path, 'rb') as f:
+            image = pyspng.load(f.read())
+        # RGB(A) -> BGR, the channel order cv2.imread would give
+        image = np.ascontiguousarray(image[:, :, 2::-1])
+    else:
         image = cv2.imread(img_path)
-        image = np.asarray(image)
-        visual = Visualizer(image, metadata=metadata)
-        with open(scene_path, "r") as f:
-            scene_struct = json.load(f)
-        
-        referent = scene_struct['referent']
-        masks = []
-        for i, obj in enumerate(scene_struct['objects']):
-            temp = obj['size'] + " " + obj['color'] + " " + obj['material'] + " " + obj['shape']
-            #print(temp, referent)
-            if temp == referent:
+    return image, scene_struct, img_path, scene_path, out_img_path
+
+# the referent is described as "<size> <color> <material> <shape>"
+_referent_key = itemgetter('size', 'color', 'material', 'shape')
+
+def dump_scene(scene_path, scene_struct):
+    # write to a temporary file and rename, so a crash never leaves a partial scene
+    data = orjson.dumps(scene_struct)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    tmp = scene_path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, scene_path)
+
+def tag_one(image, scene_struct, scene_path, args):
+    referent = scene_struct['referent']
+    ref_key = tuple(referent.split(' ', 3))
+    for i, obj in enumerate(scene_struct['objects']):
+        #print(obj, referent)
+        if _referent_key(obj) == ref_key:
+            if scene_struct.get('referent_id') != i+1:
+                # only write the scene back when the id is new
                 scene_struct['referent_id'] = i+1
-                print(i+1)
-            masks.append(decode(obj['mask']))
-        
-        print(scene_struct['utterance'])
-        print(referent)
-        
+                dump_scene(scene_path, scene_struct)
+            log.debug('referent id: %d', i+1)
+            break
+    
+    # decode all masks into an H x W x N stack
+    masks = decode_masks([obj['mask'] for obj in scene_struct['objects']])
+    if masks.shape[:2] != image.shape[:2]:
+        # nearest-neighbour resize to the (reduced) background
+        ys = np.arange(image.shape[0]) * masks.shape[0] // image.shape[0]
+        xs = np.arange(image.shape[1]) * masks.shape[1] // image.shape[1]
+        masks = masks[ys[:, None], xs]
+    
+    log.debug('utterance: %s', scene_struct['utterance'])
+    log.debug('referent: %s', referent)
+    
+    if args.fast_render and args.use_gpu == 1 and cp is not None:
+        im = draw_marks_gpu(image, masks, alpha=0.02)
+    elif args.fast_render:
+        im = draw_marks(image, masks, alpha=0.02, max_objects=args.max_objects)
+    else:
+        visual = get_visualizer(image)
         label = 1
-        for i, mask in enumerate(masks):
-            demo = visual.draw_binary_mask_with_number(mask, text=str(label), label_mode="Number", alpha=0.02, anno_mode='Mark')
+        for k in range(masks.shape[2]):
+            color = _MARK_COLORS[k % len(_MARK_COLORS)] / 255.0
+            demo = visual.draw_binary_mask_with_number(masks[:, :, k], text=str(label), color=color, label_mode="Number", alpha=0.02, anno_mode='Mark')
 
             label += 1
             
         im = demo.get_image()
-        #print(im)
-        cv2.imwrite(out_img_path, im)
-        print(out_img_path)
+    #print(im)
+    return im
+
+def save_one(out_img_path, im, args, key=None):
+    if args.out_ext == 'jpg':
+        cv2.imwrite(out_img_path, im, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    elif fpng is not None:
+        rgb = np.ascontiguousarray(im[:, :, ::-1])
+        fpng.fpng_encode_image_to_file(out_img_path, rgb.tobytes(), rgb.shape[1], rgb.shape[0], 3)
+    else:
+        # level 1 deflates several times faster than the default 3 for a few % more bytes
+        cv2.imwrite(out_img_path, im, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if key is not None:
+        # the key goes last, so it never vouches for a half-written image
+        with open(out_img_path + '.key.tmp', 'w') as f:
+            f.write(key)
+        os.replace(out_img_path + '.key.tmp', out_img_path + '.key')
+    log.debug('wrote %s', out_img_path)
+
+def tag_and_save(item, args, save=save_one):
+    image, scene_struct, img_path, scene_path, out_img_path = item
+    im = tag_one(image, scene_struct, scene_path, args)
+    # keyed on the scene as written back by tag_one, which is what the next run loads
+    key = cache_key(scene_struct, img_path, args) if args.cache else None
+    return save(out_img_path, im, args, key)
+
+def process_one(i, args):
+    item = load_one(i, args)
+    if item is not None:
+        tag_and_save(item, args)
+
+def run_pipelined(args, prefetch=4):
+    """
+    Tag the images in this process while two threads read the next images
+    ahead of time and write the finished ones behind, so that the disk I/O
+    overlaps with the tagging.
+    """
+    _init_worker(args=args)
+    with ThreadPoolExecutor(max_workers=2) as io:
+        pending = deque(io.submit(load_one, i, args) for i in range(min(prefetch, args.num_images)))
+        next_i = len(pending)
+        writes = []
+        while pending:
+            item = pending.popleft().result()
+            if next_i < args.num_images:
+                pending.append(io.submit(load_one, next_i, args))
+                next_i += 1
+            if item is None:
+                continue
+            writes.append(tag_and_save(item, args, save=partial(io.submit, save_one)))
+        for w in writes:
+            w.result()
+
+def main(args):
+    if args.scene_bundle is not None and scene_bundle_is_stale(args):
+        build_scene_bundle(args)
+    if args.workers <= 1:
+        run_pipelined(args)
+        return
+    # every image is independent, so tag them in parallel; the thread limits must
+    # be in the environment before the workers start for OpenMP/MKL to pick them up
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = '1'
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(True, args)) as ex:
+        list(ex.map(partial(process_one, args=args), range(args.num_images)))
         
 if __name__ == '__main__':
     #argv = utils.extract_args()
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     main(args)
     
 
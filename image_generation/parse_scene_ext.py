@@ -0,0 +1,472 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+"""
+parse_scene, split out of render_images.py so that it can be compiled ahead of
+time. It only touches plain Python data (no bpy), so the module can be built
+into a C extension that Python picks up in place of this file, e.g.
+
+  mypyc parse_scene_ext.py
+or
+  cythonize -i parse_scene_ext.py
+
+from the image_generation directory. Without a build the pure Python module is
+imported as usual. Locals are typed with type comments rather than annotations
+so the file still runs on the Python 3.5 bundled with Blender 2.7x.
+"""
+
+import sys, json, os
+from collections import defaultdict
+
+# print parse_scene's intermediate names and 'all' utterances
+_DEBUG_PARSE = False
+
+# the quantifier of a (kind, body) neighbour description, as it reads in an utterance
+_DESCRIP_PREFIX = {'some': "some ", 'all': "all ", 'one': "Exactly one all "}
+
+
+def _contig_ngrams(lst: list) -> tuple:
+  # contiguous 1-, 2-, 3- and 4-attribute names, e.g. "red", "red rubber", ...
+  return ([" ".join(lst[i:i+1]) for i in range(len(lst))],
+          [" ".join(lst[i:i+2]) for i in range(len(lst)-1)],
+          [" ".join(lst[i:i+3]) for i in range(len(lst)-2)],
+          [" ".join(lst[i:i+4]) for i in range(len(lst)-3)])
+
+
+def _classify(comb: str, image_2ids: dict, ids_set: frozenset) -> tuple:
+  # (kind, body) for a neighbour name: 'some' unless every object it names is in ids_set
+  all_ids = image_2ids[comb]
+  if not ids_set.issuperset(all_ids):
+    return ('some', comb)
+  elif len(all_ids) == 1:
+    return ('one', comb)
+  return ('all', comb)
+
+
+def parse_scene(scene_dict: dict, img_template: str) -> None:
+  # return the parsed sentences from the dict
+  objects = scene_dict["objects"]
+  relationships = scene_dict["relationships"]
+  len_objects = len(objects)
+  # object attributed descriptions
+  objd_lists = []
+  objds = []
+  for obj in objects:
+    objd_list = [sys.intern(obj['size']), sys.intern(obj['color']), sys.intern(obj['material']), sys.intern(obj['shape'])]
+    objd_lists.append(objd_list)
+    objds.append(" ".join(objd_list))
+  # the joined names of an attribute list are needed by every pass below, and
+  # every object shows up as a neighbour of many others, so they are built once
+  ngram_cache = {}  # type: dict
+  def cached_ngrams(objectd_list):
+    key = tuple(objectd_list)
+    grams = ngram_cache.get(key)
+    if grams is None:
+      grams = ngram_cache[key] = _contig_ngrams(objectd_list)
+    return grams
+  # 1. image-level description
+  image_some2ids = {}
+  # (is_some, count) per name in image_some2ids, so readers probe once
+  image_meta = {}
+  image_all = []
+  image_2ids = {}
+
+  # code every attribute as an integer and keep, per code, a bitmask of the
+  # objects carrying it; the objects matching an attribute subset are then
+  # the AND of its masks
+  vocab = {}  # type: dict
+  objd_codes = [[vocab.setdefault(attr, len(vocab)) for attr in objd_list] for objd_list in objd_lists]
+  attr_masks = [0] * len(vocab)
+  for j, codes in enumerate(objd_codes):
+    for code in codes:
+      attr_masks[code] |= 1 << j
+  mask_to_ids = {}  # type: dict
+  def ids_of(mask):
+    obj_inds = mask_to_ids.get(mask)
+    if obj_inds is None:
+      obj_inds = mask_to_ids[mask] = [j for j in range(len_objects) if mask >> j & 1]
+    return obj_inds
+  full_counts = defaultdict(list)
+  for j, objd in enumerate(objds):
+    full_counts[objd].append(j)
+  
+  for i, objd_list in enumerate(objd_lists):
+    # per object processing
+    masks = [attr_masks[code] for code in objd_codes[i]]
+    ## single item
+    for attr, mask in zip(objd_list, masks):
+      obj_inds = ids_of(mask)
+      count = len(obj_inds)
+      if count != len_objects:
+        image_some2ids[attr] = obj_inds
+        image_meta[attr] = (True, count)
+      else:
+        image_all.append(attr)
+      image_2ids[attr] = obj_inds
+    ## double items
+    _, comb2ds, comb3ds, _ = cached_ngrams(objd_list)
+    #comb2d_lists = [set(_) for _ in itertools.combinations(objd_list, 2)]
+    #comb2ds = [" ".join(list(_)) for _ in comb2d_lists]
+    for k in range(len(comb2ds)):
+      # (red, ball)
+      obj_inds = ids_of(masks[k] & masks[k+1])
+      count = len(obj_inds)
+          
+      if count != len_objects:
+        image_some2ids[comb2ds[k]] = obj_inds
+        image_meta[comb2ds[k]] = (True, count)
+      else:
+        image_all.append(comb2ds[k])
+      image_2ids[comb2ds[k]] = obj_inds
+    ## triple items
+    #comb3d_lists = [set(_) for _ in itertools.combinations(objd_list, 3)]
+    #comb3ds = [" ".join(list(_)) for _ in comb3d_lists]
+    for k in range(len(comb3ds)):
+      obj_inds = ids_of(masks[k] & masks[k+1] & masks[k+2])
+      count = len(obj_inds)
+
+      if count != len_objects:
+        image_some2ids[comb3ds[k]] = obj_inds
+        image_meta[comb3ds[k]] = (True, count)
+      else:
+        image_all.append(comb3ds[k])
+      image_2ids[comb3ds[k]] = obj_inds
+    ## Full items
+    obj_inds = full_counts[objds[i]]
+    count = len(obj_inds)
+
+    if count != len_objects:
+      image_some2ids[objds[i]] = obj_inds
+      image_meta[objds[i]] = (True, count)
+    else:
+      image_all.append(objds[i])
+    image_2ids[objds[i]] = obj_inds
+  if _DEBUG_PARSE:
+    print(image_2ids.keys())
+  # 2. extrinsic, object-level
+  ## tree, node structure
+  objects_structs = []  # type: list
+  for i, objd in enumerate(objds):
+    # "big red rubber ball"
+    ## Full items
+    objd_list = objd_lists[i]
+    full_current_objd = {"obj":objd, "id": i, "left_names": [], "left_child": [], "right_child": [], "behind_child": [], "front_child": []}  # type: dict
+    ### left_child: ["some balls"]
+    available_primary_names = full_current_objd['left_names']
+    available_primary_names.append("some objects")
+    # first, all some just by object-level
+    # some => all, left
+    # 1. right, some => all
+    # 2. left, some ==> all
+    # generating all possible names, where objd is 4D
+    comb1d_lists, comb2d_lists, comb3d_lists, _ = cached_ngrams(objd_list)
+    ## 1. first round
+    '''
+    if objd in image_some2ids:
+      if len(image_some2ids[objd]) == 1:
+        # "all"
+        available_primary_names.append("Exactly one all "+objd)
+      else:
+        available_primary_names.append("some "+objd)
+    else:
+      available_primary_names.append("all "+objd)
+    '''
+    for comb1d in comb1d_lists:
+      is_some, cnt = image_meta.get(comb1d, (False, len_objects))
+      if is_some:
+        available_primary_names.append("Exactly one all "+comb1d if cnt == 1 else "some "+comb1d)
+      else:
+        available_primary_names.append("all "+comb1d)
+    '''
+    for comb2d in comb2d_lists:
+      if comb2d in image_some2ids:
+        if len(image_some2ids[comb2d]) == 1:
+          available_primary_names.append("Exactly one all "+comb2d)
+        else:
+          available_primary_names.append("some "+comb2d)
+      else:
+        available_primary_names.append("all "+comb2d)
+    
+    for comb3d in comb3d_lists:
+      if comb3d in image_some2ids:
+        if len(image_some2ids[comb3d]) == 1:
+          available_primary_names.append("Exactly one all "+comb3d)
+        else:
+          available_primary_names.append("some "+comb3d)
+      else:
+        available_primary_names.append("all "+comb3d)
+    '''
+    ## 2. map the relationships from ids to full names
+    left_rel = relationships['left'][i]
+    right_rel = relationships['right'][i]
+    front_rel = relationships['front'][i]
+    behind_rel = relationships['behind'][i]
+    # per relation processing
+    for rel_obj_ind in left_rel:
+      rel_objd_list = objd_lists[rel_obj_ind]
+      full_current_objd['left_child'].append(rel_objd_list)
+
+    for rel_obj_ind in right_rel:
+      rel_objd_list = objd_lists[rel_obj_ind]
+      full_current_objd['right_child'].append(rel_objd_list)
+
+    for rel_obj_ind in front_rel:
+      rel_objd_list = objd_lists[rel_obj_ind]
+      full_current_objd['front_child'].append(rel_objd_list)
+
+    for rel_obj_ind in behind_rel:
+      rel_objd_list = objd_lists[rel_obj_ind]
+      full_current_objd['behind_child'].append(rel_objd_list)
+
+    objects_structs.append(full_current_objd)
+  ## adjust the right names
+  # neighbour ids as frozensets, built once instead of set(...) in every test
+  rel_sets = {d: [frozenset(x) for x in relationships[d]] for d in ('left', 'right', 'front', 'behind')}
+  for i, object_struct in enumerate(objects_structs):
+    # object-centric per relation processing
+    object_struct['left'] = []
+    object_struct['right'] = []
+    object_struct['front'] = []
+    object_struct['behind'] = []
+    
+    left_objects = object_struct["left_child"]
+    left_object_ids = rel_sets['left'][i]
+
+    right_objects = object_struct["right_child"]
+    right_object_ids = rel_sets['right'][i]
+
+    front_objects = object_struct["front_child"]
+    front_object_ids = rel_sets['front'][i]
+
+    behind_objects = object_struct["behind_child"]
+    behind_object_ids = rel_sets['behind'][i]
+    dir_table = [('left', left_objects, left_object_ids), ('right', right_objects, right_object_ids),
+                 ('front', front_objects, front_object_ids), ('behind', behind_objects, behind_object_ids)]
+    # process every direction with the same body
+    for dname, objects_list, ids_set in dir_table:
+      for objectd_list in objects_list:
+        # "big red rubber ball"
+        comb1d_lists, comb2d_lists, comb3d_lists, comb4d_lists = cached_ngrams(objectd_list)
+        # the 2d, 3d and 4d names are handled the same way, but are not used yet
+        # 1d
+        object_struct[dname].extend([_classify(comb1d, image_2ids, ids_set) for comb1d in comb1d_lists])
+  # adjust the primary names
+  utterances = []
+  for i, object_struct in enumerate(objects_structs):
+    # object-centric
+    primary_names = object_struct["left_names"]
+    for name in primary_names:
+      if "some" in name:
+        name_ = name.replace("some ", "", 1)
+        if name_ == "objects":
+            continue
+        primary_object_ids = set(image_2ids[name_]) # all
+        
+        # per relation
+        ## left
+        for kind, body in object_struct['left']: # on the right of
+          descrip = _DESCRIP_PREFIX[kind] + body
+          count_ids = set()
+          some_flag = False
+          #print(descrip)
+          
+          if kind != 'some':
+            object_under_discuss_name = body
+            #print(descrip)
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for second_object_id in second_object_ids:
+              #
+              if not rel_sets['right'][second_object_id].issuperset(primary_object_ids):
+                some_flag = True
+                count_ids.update(primary_object_ids & rel_sets['right'][second_object_id])
+                if len(count_ids) > 1:
+                  break
+              
+          else:
+            object_under_discuss_name = body
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for primary_object_id in primary_object_ids:
+              if rel_sets['left'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
+              else:
+                count_ids.add(primary_object_id)
+              if some_flag and len(count_ids) > 1:
+                break
+                
+          if some_flag:
+            utterances.append("some "+name_+" on the right of "+descrip)
+          else:
+            utterances.append("all "+name_+" on the right of "+descrip)
+            if _DEBUG_PARSE:
+              print("****", utterances[-1])
+            
+          if len(count_ids) == 1:
+            utterances[-1] = "Exactly one " + utterances[-1]
+            
+        ## right
+        for kind, body in object_struct['right']:
+          descrip = _DESCRIP_PREFIX[kind] + body
+          count_ids = set()
+          some_flag = False
+          if kind != 'some':
+            object_under_discuss_name = body
+            #print(descrip)
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for second_object_id in second_object_ids:
+              #
+              if not rel_sets['left'][second_object_id].issuperset(primary_object_ids):
+                some_flag = True
+                count_ids.update(primary_object_ids & rel_sets['left'][second_object_id])
+                if len(count_ids) > 1:
+                  break
+            
+          else:
+            object_under_discuss_name = body
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for primary_object_id in primary_object_ids:
+              if rel_sets['right'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
+              else:
+                count_ids.add(primary_object_id)
+              if some_flag and len(count_ids) > 1:
+                break
+                
+          if some_flag:
+            utterances.append("some "+name_+" on the left of "+descrip)
+          else:
+            utterances.append("all "+name_+" on the left of "+descrip)
+            #print("****", utterances[-1])
+
+          if len(count_ids) == 1:
+            utterances[-1] = "Exactly one " + utterances[-1]
+            
+        ## front
+        for kind, body in object_struct['front']:
+          descrip = _DESCRIP_PREFIX[kind] + body
+          count_ids = set()
+          some_flag = False
+          if kind != 'some':
+            object_under_discuss_name = body
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for second_object_id in second_object_ids:
+              #
+              if not rel_sets['behind'][second_object_id].issuperset(primary_object_ids):
+                some_flag = True
+                count_ids.update(primary_object_ids & rel_sets['behind'][second_object_id])
+                if len(count_ids) > 1:
+                  break
+                  
+              
+          else:
+            object_under_discuss_name = body
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for primary_object_id in primary_object_ids:
+              if rel_sets['front'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
+              else:
+                count_ids.add(primary_object_id)
+              if some_flag and len(count_ids) > 1:
+                break
+
+          if some_flag:
+            utterances.append("some "+name_+" behind "+descrip)
+          else:
+            utterances.append("all "+name_+" behind "+descrip)
+            #print("****", utterances[-1])
+          if len(count_ids) == 1:
+            utterances[-1] = "Exactly one " + utterances[-1]
+                
+        ## behind
+        for kind, body in object_struct['behind']:
+          descrip = _DESCRIP_PREFIX[kind] + body
+          some_flag = False
+          count_ids = set()
+          if kind != 'some':
+            object_under_discuss_name = body
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for second_object_id in second_object_ids:
+              #
+              if not rel_sets['front'][second_object_id].issuperset(primary_object_ids):
+                some_flag = True
+                count_ids.update(primary_object_ids & rel_sets['front'][second_object_id])
+                if len(count_ids) > 1:
+                  break
+              #elif not some_flag:
+              #  print("???????", descrip)
+              #  print(some_flag, name_)
+              #  print(primary_object_ids)
+              #  print(second_object_ids)
+                
+          else:
+            object_under_discuss_name = body
+            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            for primary_object_id in primary_object_ids:
+              if rel_sets['behind'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
+              else:
+                count_ids.add(primary_object_id)
+              if some_flag and len(count_ids) > 1:
+                break
+
+          if some_flag:
+            utterances.append("some "+name_+" in front of "+descrip)
+          else:
+            utterances.append("all "+name_+" in front of "+descrip)
+            #print("****", utterances[-1])
+          if len(count_ids) == 1:
+            utterances[-1] = "Exactly one " + utterances[-1]
+      else: # all
+        name_ = name.replace("all ", "", 1)
+        if name_ == "objects":
+            continue
+
+        primary_object_ids = set(image_2ids[name_]) # all
+        ## left
+        for _, descrip in object_struct['left']:
+          # All balls are on the right of xxx.
+          ## avoid trivial expressions
+          if descrip == name_:
+            continue
+          utterances.append("some " + name_ + "on the right of" + descrip)
+
+        ## right
+        for _, descrip in object_struct['right']:
+          # All balls are on the left of xxx.
+          ## avoid trivial expressions
+          if descrip == name_:
+            continue
+          utterances.append("some " + name_ + "on the left of" + descrip)
+
+        ## front
+        for _, descrip in object_struct['front']:
+          # All balls are behind xxx.
+          ## avoid trivial expressions
+          if descrip == name_:
+            continue
+          utterances.append("some " + name_ + "behind" + descrip)
+          
+        ## behind
+        for _, descrip in object_struct['behind']:
+          # All balls are on the front of xxx.
+          ## avoid trivial expressions
+          if descrip == name_:
+            continue
+          utterances.append("some " + name_ + "on the front of" + descrip)
+              
+                
+  # intrinsic: image_some2ids.keys()/ image_all
+  some = image_some2ids.keys()
+  intri_dict = {"some": list(some), "all": list(image_all)}
+  with open("../output/"+img_template.split(".")[0]+"_intrinsic.json", "w") as f:
+    json.dump(intri_dict, f)
+  # extrinsic: utterances
+  print("The number of utterances:", len(utterances))
+  for utterance in list(set(utterances)):
+    if not os.path.exists("../output/utterances/"):
+        os.mkdir("../output/utterances/")
+    with open("../output/utterances/"+utterance+".txt", "a") as f:
+      f.write(img_template)
@@ -6,12 +6,14 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile
+import math, sys, random, argparse, json, os, tempfile, functools, atexit, subprocess
 from datetime import datetime as dt
 from collections import Counter
-import copy
-import itertools
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+try:
+  import orjson
+except ImportError:
+  orjson = None
 """
 Renders random scenes using Blender, each with with a random number of objects;
 each object has a random size, position, color, and shape. Objects will be
@@ -43,6 +45,8 @@ if INSIDE_BLENDER:
     print("$VERSION is your Blender version (such as 2.78).")
     sys.exit(1)
 
+from parse_scene_ext import parse_scene
+
 parser = argparse.ArgumentParser()
 
 # Input options
@@ -128,7 +132,7 @@ parser.add_argument('--json_template', default='ad_hoc_0.json',
 parser.add_argument('--license',
     default="Creative Commons Attribution (CC-BY 4.0)",
     help="String to store in the \"license\" field of the generated JSON file")
-parser.add_argument('--date', default=dt.today().strftime("%m/%d/%Y"),
+parser.add_argument('--date', default=None,
     help="String to store in the \"date\" field of the generated JSON file; " +
          "defaults to today's date")
 
@@ -137,6 +141,16 @@ parser.add_argument('--use_gpu', default=0, type=int,
     help="Setting --use_gpu 1 enables GPU-accelerated rendering using CUDA. " +
          "You must have an NVIDIA GPU with the CUDA toolkit installed for " +
          "to work.")
+parser.add_argument('--num_workers', default=1, type=int,
+    help="Number of background Blender processes to split the images " +
+         "across. Each worker renders a contiguous range of indices; with " +
+         "--use_gpu 1 the workers are assigned to the GPUs round-robin.")
+parser.add_argument('--gpu_device', default=None, type=int,
+    help="Render on only this GPU (taken modulo the number of GPUs) instead " +
+         "of all of them; set for each worker by --num_workers.")
+parser.add_argument('--debug', default=0, type=int,
+    help="Setting --debug 1 writes the per-scene JSON files indented for " +
+         "reading; otherwise they are written compactly.")
 parser.add_argument('--width', default=480, type=int,
     help="The width (in pixels) for the rendered images")
 parser.add_argument('--height', default=320, type=int,
@@ -156,685 +170,29 @@ parser.add_argument('--render_min_bounces', default=8, type=int,
     help="The minimum number of bounces to use for rendering.")
 parser.add_argument('--render_max_bounces', default=8, type=int,
     help="The maximum number of bounces to use for rendering.")
-parser.add_argument('--render_tile_size', default=256, type=int,
+parser.add_argument('--render_tile_size', default=None, type=int,
     help="The tile size to use for rendering. This should not affect the " +
          "quality of the rendered image but may affect the speed; CPU-based " +
          "rendering may achieve better performance using smaller tile sizes " +
-         "while larger tile sizes may be optimal for GPU-based rendering.")
-
-
-def parse_scene(scene_dict, img_template: str):
-  # return the parsed sentences from the dict
-  objects = scene_dict["objects"]
-  relationships = scene_dict["relationships"]
-  len_objects = len(objects)
-  # object attributed descriptions
-  objd_lists = []
-  objds = []
-  for obj in objects:
-    objd = [obj['size'], obj['color'], obj['material'], obj['shape']]
-    objd_lists.append(objd)
-    objds.append(" ".join(objd))
-  # 1. image-level description
-  image_some2ids = {}
-  image_all = []
-  image_2ids = {}
+         "while larger tile sizes may be optimal for GPU-based rendering. " +
+         "Defaults to 16 for CPU and 256 for GPU rendering; rounded to a " +
+         "power of two.")
+parser.add_argument('--render_tile_x', default=None, type=int,
+    help="Overrides --render_tile_size for the tile width.")
+parser.add_argument('--render_tile_y', default=None, type=int,
+    help="Overrides --render_tile_size for the tile height.")
+
+
+def dump_json(obj, f, debug=False):
+  # compact JSON (orjson when it is installed), or indented for --debug runs
+  if debug:
+    json.dump(obj, f, indent=2)
+  elif orjson is not None:
+    f.write(orjson.dumps(obj).decode())
+  else:
+    json.dump(obj, f, separators=(',', ':'))
+
 
-  
-  for i, objd_list in enumerate(objd_lists):
-    # per object processing
-    ## single item
-    for attr in objd_list:
-      count = 0
-      obj_inds = []
-      # Traverse 
-      for j, objd in enumerate(objds):
-        if attr in objd:
-          count += 1
-          obj_inds.append(j)
-      if count != len_objects:
-        image_some2ids[attr] = obj_inds
-      else:
-        image_all.append(attr)
-      image_2ids[attr] = obj_inds
-    ## double items
-    comb1d_lists = []
-    comb1ds = []
-    comb2d_lists = []
-    comb2ds = []
-    comb3d_lists = []
-    comb3ds = []
-
-    for comb_i, comb_j in itertools.combinations(range(len(objd_list)+1), 2):
-      if len(objd_list[comb_i:comb_j]) == 1:
-        comb1d_lists.append(set(objd_list[comb_i:comb_j]))
-        comb1ds.append(" ".join(objd_list[comb_i:comb_j]))
-      elif len(objd_list[comb_i:comb_j]) == 2:
-        comb2d_lists.append(set(objd_list[comb_i:comb_j]))
-        comb2ds.append(" ".join(objd_list[comb_i:comb_j]))
-      elif len(objd_list[comb_i:comb_j]) == 3:
-        comb3d_lists.append(set(objd_list[comb_i:comb_j]))
-        comb3ds.append(" ".join(objd_list[comb_i:comb_j]))
-    #comb2d_lists = [set(_) for _ in itertools.combinations(objd_list, 2)]
-    #comb2ds = [" ".join(list(_)) for _ in comb2d_lists]
-    for k, comb2d_set in enumerate(comb2d_lists):
-      # (red, ball)
-      count = 0
-      obj_inds = []
-      for j, new_objd_list in enumerate(objd_lists):
-        if len(set(new_objd_list) - comb2d_set) == 2:
-          count += 1
-          obj_inds.append(j)
-          
-      if count != len_objects:
-        image_some2ids[comb2ds[k]] = obj_inds
-      else:
-        image_all.append(comb2ds[k])
-      image_2ids[comb2ds[k]] = obj_inds
-    ## triple items
-    #comb3d_lists = [set(_) for _ in itertools.combinations(objd_list, 3)]
-    #comb3ds = [" ".join(list(_)) for _ in comb3d_lists]
-    for k, comb3d_set in enumerate(comb3d_lists):
-      count = 0
-      obj_inds = []
-      for j, new_objd_list in enumerate(objd_lists):
-        if len(set(new_objd_list) - comb3d_set) == 1:
-          count += 1
-          obj_inds.append(j)
-
-      if count != len_objects:
-        image_some2ids[comb3ds[k]] = obj_inds
-      else:
-        image_all.append(comb3ds[k])
-      image_2ids[comb3ds[k]] = obj_inds
-    ## Full items
-    count = 0
-    obj_inds = []
-    for j, new_objd_list in enumerate(objd_lists):
-      if new_objd_list == objd_list:
-        count += 1
-        obj_inds.append(j)
-
-    if count != len_objects:
-      image_some2ids[objds[i]] = obj_inds
-    else:
-      image_all.append(objds[i])
-    image_2ids[objds[i]] = obj_inds
-  print(image_2ids.keys())
-  # 2. extrinsic, object-level
-  ## tree, node structure
-  objects_structs = []
-  for i, objd in enumerate(objds):
-    # "big red rubber ball"
-    ## Full items
-    objd_list = objd_lists[i]
-    full_current_objd = {"obj":objd, "id": i, "left_names": [], "left_child": [], "right_child": [], "behind_child": [], "front_child": []}
-    ### left_child: ["some balls"]
-    available_primary_names = full_current_objd['left_names']
-    available_primary_names.append("some objects")
-    # first, all some just by object-level
-    # some => all, left
-    # 1. right, some => all
-    # 2. left, some ==> all
-    # generating all possible names, where objd is 4D
-    comb1d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objd_list, 1)]
-    comb2d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objd_list, 2)]
-    comb3d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objd_list, 3)]
-    
-    for comb_i, comb_j in itertools.combinations(range(len(objd_list)+1), 2):
-      if len(objd_list[comb_i:comb_j]) == 1:
-        comb1d_lists.append(" ".join(objd_list[comb_i:comb_j]))
-        #comb1ds.append(" ".join(objd_list[comb_i:comb_j]))
-      elif len(objd_list[comb_i:comb_j]) == 2:
-        comb2d_lists.append(" ".join(objd_list[comb_i:comb_j]))#set(stuff[i:j]))
-        #comb2ds.append(" ".join(objd_list[comb_i:comb_j]))
-      
-      elif len(objd_list[comb_i:comb_j]) == 3:
-        comb3d_lists.append(" ".join(objd_list[comb_i:comb_j]))#set(stuff[i:j]))
-        #comb3ds.append(" ".join(objd_list[comb_i:comb_j]))
-    ## 1. first round
-    '''
-    if objd in image_some2ids:
-      if len(image_some2ids[objd]) == 1:
-        # "all"
-        available_primary_names.append("Exactly one all "+objd)
-      else:
-        available_primary_names.append("some "+objd)
-    else:
-      available_primary_names.append("all "+objd)
-    '''
-    for comb1d in comb1d_lists:
-      if comb1d in image_some2ids:
-        if len(image_some2ids[comb1d]) == 1:
-          available_primary_names.append("Exactly one all "+comb1d)
-        else:
-          available_primary_names.append("some "+comb1d)
-      else:
-        available_primary_names.append("all "+comb1d)
-    '''
-    for comb2d in comb2d_lists:
-      if comb2d in image_some2ids:
-        if len(image_some2ids[comb2d]) == 1:
-          available_primary_names.append("Exactly one all "+comb2d)
-        else:
-          available_primary_names.append("some "+comb2d)
-      else:
-        available_primary_names.append("all "+comb2d)
-    
-    for comb3d in comb3d_lists:
-      if comb3d in image_some2ids:
-        if len(image_some2ids[comb3d]) == 1:
-          available_primary_names.append("Exactly one all "+comb3d)
-        else:
-          available_primary_names.append("some "+comb3d)
-      else:
-        available_primary_names.append("all "+comb3d)
-    '''
-    ## 2. map the relationships from ids to full names
-    left_rel = relationships['left'][i]
-    right_rel = relationships['right'][i]
-    front_rel = relationships['front'][i]
-    behind_rel = relationships['behind'][i]
-    # per relation processing
-    for rel_obj_ind in left_rel:
-      rel_objd_list = objd_lists[rel_obj_ind]
-      full_current_objd['left_child'].append(rel_objd_list)
-
-    for rel_obj_ind in right_rel:
-      rel_objd_list = objd_lists[rel_obj_ind]
-      full_current_objd['right_child'].append(rel_objd_list)
-
-    for rel_obj_ind in front_rel:
-      rel_objd_list = objd_lists[rel_obj_ind]
-      full_current_objd['front_child'].append(rel_objd_list)
-
-    for rel_obj_ind in behind_rel:
-      rel_objd_list = objd_lists[rel_obj_ind]
-      full_current_objd['behind_child'].append(rel_objd_list)
-
-    objects_structs.append(full_current_objd)
-  ## adjust the right names
-  for i, object_struct in enumerate(objects_structs):
-    # object-centric per relation processing
-    object_struct['left'] = []
-    object_struct['right'] = []
-    object_struct['front'] = []
-    object_struct['behind'] = []
-    
-    left_objects = object_struct["left_child"]
-    left_object_ids = relationships['left'][i]
-
-    right_objects = object_struct["right_child"]
-    right_object_ids = relationships['right'][i]
-
-    front_objects = object_struct["front_child"]
-    front_object_ids = relationships['front'][i]
-
-    behind_objects = object_struct["behind_child"]
-    behind_object_ids = relationships['behind'][i]
-    # process left
-    for objectd_list in left_objects:
-      # "big red rubber ball"
-      comb1d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      comb2d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      comb3d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      comb4d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      for comb_i, comb_j in itertools.combinations(range(len(objectd_list)+1), 2):
-        if len(objectd_list[comb_i:comb_j]) == 1:
-          comb1d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 2:
-          comb2d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 3:
-          comb3d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 4:
-          comb4d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-      '''
-      # 4d
-      for comb4d in comb4d_lists:
-        # comb
-        all_ids = image_2ids[comb4d]
-        
-        if len(set(all_ids)-set(left_object_ids)) > 0:
-          #
-          object_struct['left'].append("some "+comb4d)
-          
-        elif len(all_ids) == 1:
-          object_struct["left"].append("Exactly one all "+comb4d)
-          
-        else:
-          object_struct['left'].append("all "+comb4d)
-      # 3d
-      for comb3d in comb3d_lists:
-        all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
-          object_struct['left'].append("some "+comb3d)
-        elif len(all_ids) == 1:
-          object_struct["left"].append("Exactly one all "+comb3d)
-        else:
-          object_struct['left'].append("all "+comb3d)
-      
-      # 2d
-      for comb2d in comb2d_lists:
-        all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
-          object_struct['left'].append("some "+comb2d)
-        elif len(all_ids) == 1:
-          object_struct["left"].append("Exactly one all "+comb2d)
-        else:
-          object_struct['left'].append("all "+comb2d)
-      '''
-      # 1d
-      for comb1d in comb1d_lists:
-        all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
-          object_struct['left'].append("some "+comb1d)
-        elif len(all_ids) == 1:
-          object_struct["left"].append("Exactly one all "+comb1d)
-        else:
-          object_struct['left'].append("all "+comb1d)
-    # process right
-    for objectd_list in right_objects:
-      #comb1d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      #comb2d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      #comb3d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      #comb4d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      comb1d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      comb2d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      comb3d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      comb4d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      for comb_i, comb_j in itertools.combinations(range(len(objectd_list)+1), 2):
-        if len(objectd_list[comb_i:comb_j]) == 1:
-          comb1d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 2:
-          comb2d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 3:
-          comb3d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 4:
-          comb4d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-      '''
-      # 4d
-      for comb4d in comb4d_lists:
-        # comb
-        all_ids = image_2ids[comb4d]
-        
-        if len(set(all_ids)-set(right_object_ids)) > 0:
-          #
-          object_struct['right'].append("some "+comb4d)
-          
-        elif len(all_ids) == 1:
-          object_struct["right"].append("Exactly one all "+comb4d)
-          
-        else:
-          object_struct['right'].append("all "+comb4d)
-      # 3d
-      for comb3d in comb3d_lists:
-        all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
-          object_struct['right'].append("some "+comb3d)
-        elif len(all_ids) == 1:
-          object_struct["right"].append("Exactly one all "+comb3d)
-        else:
-          object_struct['right'].append("all "+comb3d)
-      
-      # 2d
-      for comb2d in comb2d_lists:
-        all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
-          object_struct['right'].append("some "+comb2d)
-        elif len(all_ids) == 1:
-          object_struct["right"].append("Exactly one all "+comb2d)
-        else:
-          object_struct['right'].append("all "+comb2d)
-      '''
-      # 1d
-      for comb1d in comb1d_lists:
-        all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
-          object_struct['right'].append("some "+comb1d)
-        elif len(all_ids) == 1:
-          object_struct["right"].append("Exactly one all "+comb1d)
-        else:
-          object_struct['right'].append("all "+comb1d)
-    # process front
-    for objectd_list in front_objects:
-      #comb1d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      #comb2d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      #comb3d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      #comb4d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      
-      comb1d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      comb2d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      comb3d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      comb4d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      for comb_i, comb_j in itertools.combinations(range(len(objectd_list)+1), 2):
-        if len(objectd_list[comb_i:comb_j]) == 1:
-          comb1d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 2:
-          comb2d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 3:
-          comb3d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 4:
-          comb4d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-      '''
-      # 4d
-      for comb4d in comb4d_lists:
-        # comb
-        all_ids = image_2ids[comb4d]
-        
-        if len(set(all_ids)-set(front_object_ids)) > 0:
-          #
-          object_struct['front'].append("some "+comb4d)
-          
-        elif len(all_ids) == 1:
-          object_struct["front"].append("Exactly one all "+comb4d)
-          
-        else:
-          object_struct['front'].append("all "+comb4d)
-      
-      # 3d
-      for comb3d in comb3d_lists:
-        all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
-          object_struct['front'].append("some "+comb3d)
-        elif len(all_ids) == 1:
-          object_struct["front"].append("Exactly one all "+comb3d)
-        else:
-          object_struct['front'].append("all "+comb3d)
-      
-      # 2d
-      for comb2d in comb2d_lists:
-        all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
-          object_struct['front'].append("some "+comb2d)
-        elif len(all_ids) == 1:
-          object_struct["front"].append("Exactly one all "+comb2d)
-        else:
-          object_struct['front'].append("all "+comb2d)
-      '''
-      # 1d
-      for comb1d in comb1d_lists:
-        all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
-          object_struct['front'].append("some "+comb1d)
-        elif len(all_ids) == 1:
-          object_struct["front"].append("Exactly one all "+comb1d)
-        else:
-          object_struct['front'].append("all "+comb1d)
-          
-    # process behind
-    for objectd_list in behind_objects:
-      #comb1d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      #comb2d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      #comb3d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      #comb4d_lists = [" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      comb1d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 1)]
-      comb2d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 2)]
-      comb3d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 3)]
-      comb4d_lists = []#[" ".join(list(_)) for _ in itertools.combinations(objectd_list, 4)]
-      for comb_i, comb_j in itertools.combinations(range(len(objectd_list)+1), 2):
-        if len(objectd_list[comb_i:comb_j]) == 1:
-          comb1d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 2:
-          comb2d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 3:
-          comb3d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-        elif len(objectd_list[comb_i:comb_j]) == 4:
-          comb4d_lists.append(" ".join(objectd_list[comb_i:comb_j]))
-      '''
-      # 4d
-      for comb4d in comb4d_lists:
-        # comb
-        all_ids = image_2ids[comb4d]
-        
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
-          #
-          object_struct['behind'].append("some "+comb4d)
-          
-        elif len(all_ids) == 1:
-          object_struct["behind"].append("Exactly one all "+comb4d)
-          
-        else:
-          object_struct['behind'].append("all "+comb4d)
-      
-      # 3d
-      for comb3d in comb3d_lists:
-        all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
-          object_struct['behind'].append("some "+comb3d)
-        elif len(all_ids) == 1:
-          object_struct["behind"].append("Exactly one all "+comb3d)
-        else:
-          object_struct['behind'].append("all "+comb3d)
-    
-      # 2d
-      for comb2d in comb2d_lists:
-        all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
-          object_struct['behind'].append("some "+comb2d)
-        elif len(all_ids) == 1:
-          object_struct["behind"].append("Exactly one all "+comb2d)
-        else:
-          object_struct['behind'].append("all "+comb2d)
-      '''
-      # 1d
-      for comb1d in comb1d_lists:
-        all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
-          object_struct['behind'].append("some "+comb1d)
-        elif len(all_ids) == 1:
-          object_struct["behind"].append("Exactly one all "+comb1d)
-        else:
-          object_struct['behind'].append("all "+comb1d)
-  # adjust the primary names
-  utterances = []
-  for i, object_struct in enumerate(objects_structs):
-    # object-centric
-    primary_names = object_struct["left_names"]
-    for name in primary_names:
-      if "some" in name:
-        name_ = copy.deepcopy(name)
-        name_ = name_.replace("some ", "")
-        if name_ == "objects":
-            continue
-        primary_object_ids = set(image_2ids[name_]) # all
-        
-        # per relation
-        ## left
-        for descrip in object_struct['left']: # on the right of
-          count_ids = []
-          some_flag = False
-          #print(descrip)
-          
-          if "all"  in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            #print(descrip)
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['right'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['right'][second_object_id])):
-                  count_ids.append(temp)
-              
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['left'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-                
-          if some_flag:
-            utterances.append("some "+name_+" on the right of "+descrip)
-          else:
-            utterances.append("all "+name_+" on the right of "+descrip)
-            print("****", utterances[-1])
-            
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-            
-        ## right
-        for descrip in object_struct['right']:
-          count_ids = []
-          some_flag = False
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            #print(descrip)
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['left'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['left'][second_object_id])):
-                  count_ids.append(temp)
-            
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['right'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-                
-          if some_flag:
-            utterances.append("some "+name_+" on the left of "+descrip)
-          else:
-            utterances.append("all "+name_+" on the left of "+descrip)
-            #print("****", utterances[-1])
-
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-            
-        ## front
-        for descrip in object_struct['front']:
-          count_ids = []
-          some_flag = False
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['behind'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['behind'][second_object_id])):
-                  count_ids.append(temp)
-                  
-              
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['front'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-
-          if some_flag:
-            utterances.append("some "+name_+" behind "+descrip)
-          else:
-            utterances.append("all "+name_+" behind "+descrip)
-            #print("****", utterances[-1])
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-                
-        ## behind
-        for descrip in object_struct['behind']:
-          some_flag = False
-          count_ids = []
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['front'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['front'][second_object_id])):
-                  count_ids.append(temp)
-              #elif not some_flag:
-              #  print("???????", descrip)
-              #  print(some_flag, name_)
-              #  print(primary_object_ids)
-              #  print(second_object_ids)
-                
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['behind'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-
-          if some_flag:
-            utterances.append("some "+name_+" in front of "+descrip)
-          else:
-            utterances.append("all "+name_+" in front of "+descrip)
-            #print("****", utterances[-1])
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-      else: # all
-        name_ = copy.deepcopy(name)
-        name_ = name_.replace("all ", "")
-        if name_ == "objects":
-            continue
-
-        primary_object_ids = set(image_2ids[name_]) # all
-        ## left
-        for descrip_ in object_struct['left']:
-          # All balls are on the right of xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
-          ## avoid trivial expressions
-          if descrip == name_:
-            continue
-          utterances.append("some " + name_ + "on the right of" + descrip)
-
-        ## right
-        for descrip_ in object_struct['right']:
-          # All balls are on the left of xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
-          ## avoid trivial expressions
-          if descrip == name_:
-            continue
-          utterances.append("some " + name_ + "on the left of" + descrip)
-
-        ## front
-        for descrip_ in object_struct['front']:
-          # All balls are behind xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
-          ## avoid trivial expressions
-          if descrip == name_:
-            continue
-          utterances.append("some " + name_ + "behind" + descrip)
-          
-        ## behind
-        for descrip_ in object_struct['behind']:
-          # All balls are on the front of xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
-          ## avoid trivial expressions
-          if descrip == name_:
-            continue
-          utterances.append("some " + name_ + "on the front of" + descrip)
-              
-                
-  # intrinsic: image_some2ids.keys()/ image_all
-  some = image_some2ids.keys()
-  intri_dict = {"some": list(some), "all": list(image_all)}
-  with open("../output/"+img_template.split(".")[0]+"_intrinsic.json", "w") as f:
-    json.dump(intri_dict, f)
-  # extrinsic: utterances
-  print("The number of utterances:", len(utterances))
-  for utterance in list(set(utterances)):
-    if not os.path.exists("../output/utterances/"):
-        os.mkdir("../output/utterances/")
-    with open("../output/utterances/"+utterance+".txt", "a") as f:
-      f.write(img_template)
-  
 def notmain(args):
   num_digits = 1
   prefix = '%s_%s_' % (args.filename_prefix, args.split)
@@ -853,6 +211,12 @@ def notmain(args):
   if args.save_blendfiles == 1 and not os.path.isdir(args.output_blend_dir):
     os.makedirs(args.output_blend_dir)
   
+  # parse each scene on a background thread while the next one renders;
+  # parse_scene only touches plain Python data, and a single worker keeps the
+  # utterance files appended in scene order
+  parse_pool = ThreadPoolExecutor(max_workers=1)
+  parse_futures = []
+  all_scenes = []
   all_scene_paths = []
   for i in range(5):
     img_path = img_template % (i + args.start_idx)
@@ -870,18 +234,16 @@ def notmain(args):
       output_scene=scene_path,
       output_blendfile=blend_path,
     )
-    
-  # After rendering all images, combine the JSON files for each scene into a
-  # single JSON file.
-  all_scenes = []
-  for scene_path in all_scene_paths:
+    # After rendering each image, collect its JSON file for the combined
+    # JSON file written below.
     with open(scene_path, 'r') as f:
-      all_scenes.append(json.load(f))
+      scene_dict = json.load(f)
+    all_scenes.append(scene_dict)
+    parse_futures.append(parse_pool.submit(parse_scene, scene_dict, img_template % (i + args.start_idx)))
 
-  for i, scene_dict in enumerate(all_scenes):
-    # scene
-    parse_scene(scene_dict, img_template % (i + args.start_idx))
-    
+  for future in parse_futures:
+    future.result()
+  parse_pool.shutdown()
     
   output = {
     'info': {
@@ -893,7 +255,7 @@ def notmain(args):
     'scenes': all_scenes
   }
   with open(args.output_scene_file, 'w') as f:
-    json.dump(output, f)
+    dump_json(output, f)
 
 def main(args):
   num_digits = 6
@@ -935,6 +297,10 @@ def main(args):
     os.makedirs(args.output_scene_dir)
   if args.save_blendfiles == 1 and not os.path.isdir(args.output_blend_dir):
     os.makedirs(args.output_blend_dir) 
+
+  if args.num_workers > 1:
+    run_workers(args)
+    return
   
   all_scene_paths = []
   for i in range(args.num_images):
@@ -991,10 +357,152 @@ def main(args):
     'scenes': all_scenes
   }
   with open(args.output_scene_file, 'w') as f:
-    json.dump(output, f)
+    dump_json(output, f)
   '''
     
 
+def run_workers(args):
+  """
+  Render args.num_images images by splitting their indices into contiguous
+  ranges, one per background Blender process. Each worker runs main on its
+  range, including the retry until a usable scene comes out.
+  """
+  if args.num_images <= 0:
+    return
+  num_workers = min(args.num_workers, args.num_images)
+  per_worker, extra = divmod(args.num_images, num_workers)
+  script = os.path.abspath(__file__)
+  argv = utils.extract_args()
+  commands = []
+  start_idx = args.start_idx
+  for w in range(num_workers):
+    num_images = per_worker + (1 if w < extra else 0)
+    # later flags override the ones repeated from argv
+    commands.append([bpy.app.binary_path, '--background', '--python', script, '--'] + argv + [
+        '--start_idx', str(start_idx), '--num_images', str(num_images),
+        '--num_workers', '1', '--gpu_device', str(w), '--date', args.date])
+    start_idx += num_images
+  with ThreadPoolExecutor(max_workers=num_workers) as pool:
+    returncodes = list(pool.map(subprocess.call, commands))
+  failed = [w for w, code in enumerate(returncodes) if code != 0]
+  if failed:
+    raise RuntimeError('render workers %s exited with an error' % failed)
+
+
+def resolve_tile_size(args):
+  """
+  Fill in args.render_tile_x / args.render_tile_y from --render_tile_size,
+  which itself defaults to small tiles for CPU and large tiles for GPU
+  rendering; all sizes are rounded to the nearest power of two.
+  """
+  def pow2(n):
+    return 1 << max(0, int(round(math.log(max(n, 1), 2))))
+  if args.render_tile_size is None:
+    args.render_tile_size = 256 if args.use_gpu == 1 else 16
+  args.render_tile_size = pow2(args.render_tile_size)
+  args.render_tile_x = pow2(args.render_tile_x or args.render_tile_size)
+  args.render_tile_y = pow2(args.render_tile_y or args.render_tile_size)
+
+
+def enable_cycles_gpu(gpu_device=None):
+  """
+  Select the best GPU backend Cycles offers (OptiX, then CUDA, HIP, oneAPI,
+  falling back to OpenCL on older versions) and turn on every non-CPU
+  device; setting compute_device_type alone leaves the devices unused.
+  If gpu_device is given only that GPU (modulo the GPU count) is used.
+  """
+  # Blender 2.80 renamed user_preferences to preferences
+  prefs = getattr(bpy.context, 'preferences', None) or bpy.context.user_preferences
+  cycles_prefs = prefs.addons['cycles'].preferences
+  for device_type in ('OPTIX', 'CUDA', 'HIP', 'ONEAPI', 'OPENCL'):
+    try:
+      cycles_prefs.compute_device_type = device_type
+    except TypeError:
+      # not a backend this Blender build knows about
+      continue
+    cycles_prefs.get_devices()
+    devices = [d for d in cycles_prefs.devices if d.type == device_type]
+    if devices:
+      break
+  for d in cycles_prefs.devices:
+    d.use = d.type != 'CPU'
+  gpus = [d for d in cycles_prefs.devices if d.type != 'CPU']
+  if gpu_device is not None and gpus:
+    for j, d in enumerate(gpus):
+      d.use = j == gpu_device % len(gpus)
+
+
+
+@functools.lru_cache(maxsize=1)
+def _prepared_blendfile(base_scene_blendfile, material_dir):
+  """
+  Open the base scene, append all materials to it and save the result to a
+  temporary .blend that is reused for every image rendered by this process.
+  """
+  bpy.ops.wm.open_mainfile(filepath=base_scene_blendfile)
+  utils.load_materials(material_dir)
+  # The appended node groups have no users yet, so they would be dropped
+  # when the file is saved
+  for node_group in bpy.data.node_groups:
+    node_group.use_fake_user = True
+  fd, path = tempfile.mkstemp(suffix='.blend')
+  os.close(fd)
+  atexit.register(os.remove, path)
+  bpy.ops.wm.save_as_mainfile(filepath=path, copy=True)
+  return path
+
+
+def _setup_base_scene(args):
+  """
+  Reset Blender to the base scene with the materials already loaded. The
+  scene still has to be reopened for every image, since that is what clears
+  the previous objects and the light and camera jitter.
+  """
+  bpy.ops.wm.open_mainfile(filepath=_prepared_blendfile(args.base_scene_blendfile, args.material_dir))
+
+
+# cardinal directions for an unjittered camera, filled in by the first render
+_directions_cache = {}
+
+
+def compute_directions(camera, camera_jitter):
+  """
+  Figure out the left, up, and behind directions along the ground plane as
+  seen from the camera, and return all six axis-aligned directions. Without
+  camera jitter the camera never moves, so they are only computed once.
+  """
+  if camera_jitter == 0 and _directions_cache:
+    return dict(_directions_cache)
+
+  # Put a plane on the ground so we can compute cardinal directions
+  bpy.ops.mesh.primitive_plane_add(radius=5)
+  plane = bpy.context.object
+
+  plane_normal = plane.data.vertices[0].normal
+  cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
+  cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
+  cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
+  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
+  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
+  plane_up = cam_up.project(plane_normal).normalized()
+
+  # Delete the plane; we only used it for normals anyway. The base scene file
+  # contains the actual ground plane.
+  utils.delete_object(plane)
+
+  directions = {
+    'behind': tuple(plane_behind),
+    'front': tuple(-plane_behind),
+    'left': tuple(plane_left),
+    'right': tuple(-plane_left),
+    'above': tuple(plane_up),
+    'below': tuple(-plane_up),
+  }
+  if camera_jitter == 0:
+    _directions_cache.update(directions)
+  return directions
+
+
 def render_scene(args,
     num_objects=5,
     output_index=0,
@@ -1004,11 +512,8 @@ def render_scene(args,
     output_blendfile=None,
   ):
 
-  # Load the main blendfile
-  bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-
-  # Load materials
-  utils.load_materials(args.material_dir)
+  # Load the main blendfile, with the materials already in it
+  _setup_base_scene(args)
 
   # Set render arguments so we can get pixel coordinates later.
   # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
@@ -1019,16 +524,15 @@ def render_scene(args,
   render_args.resolution_x = args.width
   render_args.resolution_y = args.height
   render_args.resolution_percentage = 100
-  render_args.tile_x = args.render_tile_size
-  render_args.tile_y = args.render_tile_size
+  render_args.tile_x = args.render_tile_x
+  render_args.tile_y = args.render_tile_y
   if args.use_gpu == 1:
     # Blender changed the API for enabling CUDA at some point
     if bpy.app.version < (2, 78, 0):
       bpy.context.user_preferences.system.compute_device_type = 'CUDA'
       bpy.context.user_preferences.system.compute_device = 'CUDA_1'
     else:
-      cycles_prefs = bpy.context.user_preferences.addons['cycles'].preferences
-      cycles_prefs.compute_device_type = 'CUDA'
+      enable_cycles_gpu(args.gpu_device)
 
   # Some CYCLES-specific objd_list
   bpy.data.worlds['World'].cycles.sample_as_light = True
@@ -1038,6 +542,7 @@ def render_scene(args,
   bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
   if args.use_gpu == 1:
     bpy.context.scene.cycles.device = 'GPU'
+    bpy.context.scene.cycles.debug_use_spatial_splits = True
 
   # This will give ground-truth information about the scene and its objects
   scene_struct = {
@@ -1048,10 +553,6 @@ def render_scene(args,
       'directions': {},
   }
 
-  # Put a plane on the ground so we can compute cardinal directions
-  bpy.ops.mesh.primitive_plane_add(radius=5)
-  plane = bpy.context.object
-
   def rand(L):
     return 2.0 * L * (random.random() - 0.5)
 
@@ -1060,28 +561,9 @@ def render_scene(args,
     for i in range(3):
       bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter)
 
-  # Figure out the left, up, and behind directions along the plane and record
-  # them in the scene structure
+  # Record the cardinal directions along the ground plane in the scene structure
   camera = bpy.data.objects['Camera']
-  plane_normal = plane.data.vertices[0].normal
-  cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
-  cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
-  cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
-  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
-  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
-  plane_up = cam_up.project(plane_normal).normalized()
-
-  # Delete the plane; we only used it for normals anyway. The base scene file
-  # contains the actual ground plane.
-  utils.delete_object(plane)
-
-  # Save all six axis-aligned directions in the scene struct
-  scene_struct['directions']['behind'] = tuple(plane_behind)
-  scene_struct['directions']['front'] = tuple(-plane_behind)
-  scene_struct['directions']['left'] = tuple(plane_left)
-  scene_struct['directions']['right'] = tuple(-plane_left)
-  scene_struct['directions']['above'] = tuple(plane_up)
-  scene_struct['directions']['below'] = tuple(-plane_up)
+  scene_struct['directions'] = compute_directions(camera, args.camera_jitter)
 
   # Add random jitter to lamp positions
   if args.key_light_jitter > 0:
@@ -1108,7 +590,7 @@ def render_scene(args,
       print(e)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f, indent=2)
+    dump_json(scene_struct, f, debug=args.debug == 1)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
@@ -1124,11 +606,8 @@ def render_ad_hoc_scene(args,
     output_type_txt='easy.txt',
   ):
 
-  # Load the main blendfile
-  bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-
-  # Load materials
-  utils.load_materials(args.material_dir)
+  # Load the main blendfile, with the materials already in it
+  _setup_base_scene(args)
 
   # Set render arguments so we can get pixel coordinates later.
   # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
@@ -1139,16 +618,15 @@ def render_ad_hoc_scene(args,
   render_args.resolution_x = args.width
   render_args.resolution_y = args.height
   render_args.resolution_percentage = 100
-  render_args.tile_x = args.render_tile_size
-  render_args.tile_y = args.render_tile_size
+  render_args.tile_x = args.render_tile_x
+  render_args.tile_y = args.render_tile_y
   if args.use_gpu == 1:
     # Blender changed the API for enabling CUDA at some point
     if bpy.app.version < (2, 78, 0):
       bpy.context.user_preferences.system.compute_device_type = 'CUDA'
       bpy.context.user_preferences.system.compute_device = 'CUDA_0'
     else:
-      cycles_prefs = bpy.context.user_preferences.addons['cycles'].preferences
-      cycles_prefs.compute_device_type = 'CUDA'
+      enable_cycles_gpu(args.gpu_device)
 
   # Some CYCLES-specific objd_list
   bpy.data.worlds['World'].cycles.sample_as_light = True
@@ -1158,6 +636,7 @@ def render_ad_hoc_scene(args,
   bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
   if args.use_gpu == 1:
     bpy.context.scene.cycles.device = 'GPU'
+    bpy.context.scene.cycles.debug_use_spatial_splits = True
 
   # This will give ground-truth information about the scene and its objects
   scene_struct = {
@@ -1168,10 +647,6 @@ def render_ad_hoc_scene(args,
       'directions': {},
   }
 
-  # Put a plane on the ground so we can compute cardinal directions
-  bpy.ops.mesh.primitive_plane_add(radius=5)
-  plane = bpy.context.object
-
   def rand(L):
     return 2.0 * L * (random.random() - 0.5)
 
@@ -1180,28 +655,9 @@ def render_ad_hoc_scene(args,
     for i in range(3):
       bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter)
 
-  # Figure out the left, up, and behind directions along the plane and record
-  # them in the scene structure
+  # Record the cardinal directions along the ground plane in the scene structure
   camera = bpy.data.objects['Camera']
-  plane_normal = plane.data.vertices[0].normal
-  cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
-  cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
-  cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
-  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
-  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
-  plane_up = cam_up.project(plane_normal).normalized()
-
-  # Delete the plane; we only used it for normals anyway. The base scene file
-  # contains the actual ground plane.
-  utils.delete_object(plane)
-
-  # Save all six axis-aligned directions in the scene struct
-  scene_struct['directions']['behind'] = tuple(plane_behind)
-  scene_struct['directions']['front'] = tuple(-plane_behind)
-  scene_struct['directions']['left'] = tuple(plane_left)
-  scene_struct['directions']['right'] = tuple(-plane_left)
-  scene_struct['directions']['above'] = tuple(plane_up)
-  scene_struct['directions']['below'] = tuple(-plane_up)
+  scene_struct['directions'] = compute_directions(camera, args.camera_jitter)
 
   # Add random jitter to lamp positions
   if args.key_light_jitter > 0:
@@ -1229,16 +685,13 @@ def render_ad_hoc_scene(args,
     if utter == utterance:
       count+=1
   
-  utterance_split = utterance.split(" ")
+  utt_set = set(utterance.split(" "))
   other_utterances = []
   other_utterances_set = set()
+  # match whole attribute words; a substring test would let "red" match inside another word
+  obj_token_sets = [{obj['size'], obj['color'], obj['material'], obj['shape']} for obj in objects]
   for i, obj in enumerate(objects):
-    string = obj['size'] + " " + obj['color'] + " " + obj['material']+ " " + obj['shape']
-    temp_flag = True
-    for u_split in utterance_split:
-        if u_split not in string:
-            temp_flag = False
-    if temp_flag:
+    if utt_set.issubset(obj_token_sets[i]):
         if obj_ind != i:
             print(i, raw_utterance_obj_pairs)
             other_utterances.append(raw_utterance_obj_pairs[i][1][0])
@@ -1250,11 +703,6 @@ def render_ad_hoc_scene(args,
     else:
         f.write(output_scene + "\tDifficult"+"\n")
    
-  for i, id_utter_list in enumerate(raw_utterance_obj_pairs):
-    utter = id_utter_list[1]
-    if utter == utterance:
-        temp_obj_id = id_utter_list[0]
-
   if count > 1:
     print("break")
     return None, None
@@ -1287,7 +735,7 @@ def render_ad_hoc_scene(args,
   #  scene_struct['objects'][i]['mask'] = encode(np.asfortranarray(temp_mask))
   
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f, indent=2)
+    dump_json(scene_struct, f, debug=args.debug == 1)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
@@ -1309,12 +757,22 @@ def add_random_objects(scene_struct, num_objects, args, camera):
     material_mapping = [(v, k) for k, v in properties['materials'].items()]
     object_mapping = [(v, k) for k, v in properties['shapes'].items()]
     size_mapping = list(properties['sizes'].items())
+  color_items = list(color_name_to_rgba.items())
+  shape_to_obj_name = {v: k for k, v in object_mapping}
 
   shape_color_combos = None
   if args.shape_color_combos_json is not None:
     with open(args.shape_color_combos_json, 'r') as f:
       shape_color_combos = list(json.load(f).items())
 
+  # The cardinal directions are fixed for the whole scene, so pull their
+  # ground-plane components out of the placement loop once
+  direction_xy = []
+  for direction_name in ['left', 'right', 'front', 'behind']:
+    direction_vec = scene_struct['directions'][direction_name]
+    assert direction_vec[2] == 0
+    direction_xy.append((direction_name, direction_vec[0], direction_vec[1]))
+
   positions = []
   objects = []
   blender_objects = []
@@ -1342,14 +800,12 @@ def add_random_objects(scene_struct, num_objects, args, camera):
       margins_good = True
       for (xx, yy, rr) in positions:
         dx, dy = x - xx, y - yy
-        dist = math.sqrt(dx * dx + dy * dy)
+        dist = math.hypot(dx, dy)
         if dist - r - rr < args.min_dist:
           dists_good = False
           break
-        for direction_name in ['left', 'right', 'front', 'behind']:
-          direction_vec = scene_struct['directions'][direction_name]
-          assert direction_vec[2] == 0
-          margin = dx * direction_vec[0] + dy * direction_vec[1]
+        for direction_name, dir_x, dir_y in direction_xy:
+          margin = dx * dir_x + dy * dir_y
           if 0 < margin < args.margin:
             print(margin, args.margin, direction_name)
             print('BROKEN MARGIN!')
@@ -1364,11 +820,11 @@ def add_random_objects(scene_struct, num_objects, args, camera):
     # Choose random color and shape
     if shape_color_combos is None:
       obj_name, obj_name_out = random.choice(object_mapping)
-      color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+      color_name, rgba = random.choice(color_items)
     else:
       obj_name_out, color_choices = random.choice(shape_color_combos)
       color_name = random.choice(color_choices)
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
+      obj_name = shape_to_obj_name[obj_name_out]
       rgba = color_name_to_rgba[color_name]
 
     # For cube, adjust the size a bit
@@ -1413,55 +869,25 @@ def add_random_objects(scene_struct, num_objects, args, camera):
   return objects, blender_objects
 
 def calculate_ad_hoc_matrix(objects):
-  utterance_lists = {}
-  # measure existence
-  objects_whole_string = {}
-  for i, obj in enumerate(objects):
-    string = obj['shape']+obj['size']+obj['material']+obj['color']
-    if string not in objects_whole_string:
-      objects_whole_string[string] = 1
-    else:
-      objects_whole_string[string] += 1
-    if obj['shape'] not in utterance_lists:
-      utterance_lists[obj['shape']] = np.zeros(len(objects))
-      utterance_lists[obj['shape']][i] = 1
-    else:
-      utterance_lists[obj['shape']][i] += 1
-      
-    if obj['size'] not in utterance_lists:
-      utterance_lists[obj['size']] = np.zeros(len(objects))
-      utterance_lists[obj['size']][i] = 1
-    else:
-      utterance_lists[obj['size']][i] += 1
-    
-    if obj['material'] not in utterance_lists:
-      utterance_lists[obj['material']] = np.zeros(len(objects))
-      utterance_lists[obj['material']][i] = 1
-    else:
-      utterance_lists[obj['material']][i] += 1
-    
-    if obj['color'] not in utterance_lists:
-      utterance_lists[obj['color']] = np.zeros(len(objects))
-      utterance_lists[obj['color']][i] = 1
-    else:
-      utterance_lists[obj['color']][i] += 1
-  
+  # the only numpy user here; importing it lazily keeps it off every render's startup
+  import numpy as np
+  # one row per attribute value, in order of first appearance, with a 1 in the
+  # column of every object carrying it
+  key_ids = {}
+  rows = np.array([[key_ids.setdefault(obj[attr], len(key_ids)) for attr in ('shape', 'size', 'material', 'color')]
+                   for obj in objects], dtype=np.intp).reshape(len(objects), 4)
+  full_matrix = np.zeros((len(key_ids), len(objects)))
+  np.add.at(full_matrix, (rows, np.arange(len(objects))[:, None]), 1)
+  keys = list(key_ids)
 
   # process the column
-  full_matrix = np.zeros((len(utterance_lists.keys()), len(objects)))
-  keys = list(utterance_lists.keys())
-  for i, key in enumerate(keys):
-    utterance_lists[key] = utterance_lists[key]/(np.sum(utterance_lists[key])+1e-3)
-    full_matrix[i] = utterance_lists[key]
+  full_matrix = full_matrix/(full_matrix.sum(axis=1, keepdims=True)+1e-3)
   # transpose the matrix
   utterance_obj_pairs = []
   repeat_obj_pairs = []
   full_utterance_obj_pairs = []
   for i, obj_name in enumerate(objects):
     # current ind max
-    string = obj_name['shape']+obj_name['size']+obj_name['material']+obj_name['color']
-    #if objects_whole_string[string] > 1:
-    #  continue
     #print(full_matrix[:,i])
     if len(np.where(full_matrix[:,i]==full_matrix[:,i].max())[0]) == 1 and full_matrix[:,i].max() < 0.9:
       print(full_matrix[:,i])
@@ -1519,12 +945,22 @@ def add_ad_hoc_random_objects(scene_struct, num_objects, args, camera):
     material_mapping = [(v, k) for k, v in properties['materials'].items()]
     object_mapping = [(v, k) for k, v in properties['shapes'].items()]
     size_mapping = list(properties['sizes'].items())
+  color_items = list(color_name_to_rgba.items())
+  shape_to_obj_name = {v: k for k, v in object_mapping}
 
   shape_color_combos = None
   if args.shape_color_combos_json is not None:
     with open(args.shape_color_combos_json, 'r') as f:
       shape_color_combos = list(json.load(f).items())
 
+  # The cardinal directions are fixed for the whole scene, so pull their
+  # ground-plane components out of the placement loop once
+  direction_xy = []
+  for direction_name in ['left', 'right', 'front', 'behind']:
+    direction_vec = scene_struct['directions'][direction_name]
+    assert direction_vec[2] == 0
+    direction_xy.append((direction_name, direction_vec[0], direction_vec[1]))
+
   positions = []
   objects = []
   blender_objects = []
@@ -1552,14 +988,12 @@ def add_ad_hoc_random_objects(scene_struct, num_objects, args, camera):
       margins_good = True
       for (xx, yy, rr) in positions:
         dx, dy = x - xx, y - yy
-        dist = math.sqrt(dx * dx + dy * dy)
+        dist = math.hypot(dx, dy)
         if dist - r - rr < args.min_dist:
           dists_good = False
           break
-        for direction_name in ['left', 'right', 'front', 'behind']:
-          direction_vec = scene_struct['directions'][direction_name]
-          assert direction_vec[2] == 0
-          margin = dx * direction_vec[0] + dy * direction_vec[1]
+        for direction_name, dir_x, dir_y in direction_xy:
+          margin = dx * dir_x + dy * dir_y
           if 0 < margin < args.margin:
             print(margin, args.margin, direction_name)
             print('BROKEN MARGIN!')
@@ -1574,11 +1008,11 @@ def add_ad_hoc_random_objects(scene_struct, num_objects, args, camera):
     # Choose random color and shape
     if shape_color_combos is None:
       obj_name, obj_name_out = random.choice(object_mapping)
-      color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+      color_name, rgba = random.choice(color_items)
     else:
       obj_name_out, color_choices = random.choice(shape_color_combos)
       color_name = random.choice(color_choices)
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
+      obj_name = shape_to_obj_name[obj_name_out]
       rgba = color_name_to_rgba[color_name]
 
     # For cube, adjust the size a bit
@@ -1648,12 +1082,22 @@ def add_connective_random_objects(scene_struct, num_objects, args, camera, langu
     material_mapping = [(v, k) for k, v in properties['materials'].items()]
     object_mapping = [(v, k) for k, v in properties['shapes'].items()]
     size_mapping = list(properties['sizes'].items())
+  color_items = list(color_name_to_rgba.items())
+  shape_to_obj_name = {v: k for k, v in object_mapping}
 
   shape_color_combos = None
   if args.shape_color_combos_json is not None:
     with open(args.shape_color_combos_json, 'r') as f:
       shape_color_combos = list(json.load(f).items())
 
+  # The cardinal directions are fixed for the whole scene, so pull their
+  # ground-plane components out of the placement loop once
+  direction_xy = []
+  for direction_name in ['left', 'right', 'front', 'behind']:
+    direction_vec = scene_struct['directions'][direction_name]
+    assert direction_vec[2] == 0
+    direction_xy.append((direction_name, direction_vec[0], direction_vec[1]))
+
   positions = []
   objects = []
   blender_objects = []
@@ -1700,14 +1144,12 @@ def add_connective_random_objects(scene_struct, num_objects, args, camera, langu
       margins_good = True
       for (xx, yy, rr) in positions:
         dx, dy = x - xx, y - yy
-        dist = math.sqrt(dx * dx + dy * dy)
+        dist = math.hypot(dx, dy)
         if dist - r - rr < args.min_dist:
           dists_good = False
           break
-        for direction_name in ['left', 'right', 'front', 'behind']:
-          direction_vec = scene_struct['directions'][direction_name]
-          assert direction_vec[2] == 0
-          margin = dx * direction_vec[0] + dy * direction_vec[1]
+        for direction_name, dir_x, dir_y in direction_xy:
+          margin = dx * dir_x + dy * dir_y
           if 0 < margin < args.margin:
             print(margin, args.margin, direction_name)
             print('BROKEN MARGIN!')
@@ -1722,11 +1164,11 @@ def add_connective_random_objects(scene_struct, num_objects, args, camera, langu
     # Choose random color and shape
     if shape_color_combos is None:
       obj_name, obj_name_out = random.choice(object_mapping)
-      color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+      color_name, rgba = random.choice(color_items)
     else:
       obj_name_out, color_choices = random.choice(shape_color_combos)
       color_name = random.choice(color_choices)
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
+      obj_name = shape_to_obj_name[obj_name_out]
       rgba = color_name_to_rgba[color_name]
 
     # For cube, adjust the size a bit
@@ -1948,6 +1390,9 @@ if __name__ == '__main__':
     # Run normally
     argv = utils.extract_args()
     args = parser.parse_args(argv)
+    if args.date is None:
+      args.date = dt.today().strftime("%m/%d/%Y")
+    resolve_tile_size(args)
    
     main(args)
 
@@ -6,13 +6,16 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile
+import math, sys, random, argparse, json, os, re, tempfile
 from datetime import datetime as dt
 from collections import Counter
-import copy
 import itertools
 import numpy as np
 import shutil
+try:
+  import orjson
+except ImportError:
+  orjson = None
 """
 Renders random scenes using Blender, each with with a random number of objects;
 each object has a random size, position, color, and shape. Objects will be
@@ -180,6 +183,24 @@ for key in INTRINSIC_PRIMITIVES.keys():
   for ele in INTRINSIC_PRIMITIVES[key]:
     INVERSE_INTRINSIC_PRIMITIVES[ele] = key
 
+def dump_json(obj, f):
+  # compact JSON; orjson when it is installed, the stdlib otherwise
+  if orjson is not None:
+    f.write(orjson.dumps(obj).decode())
+  else:
+    json.dump(obj, f, separators=(',', ':'))
+
+# quantifiers stripped from a description in one pass; the longest
+# alternative comes first so "Exactly one all " is removed whole
+_QUANTIFIER_RE = re.compile(r"(?:Exactly one all |some |all )")
+
+def _ids_mask(ids):
+  # bit j set for every object id j in ids
+  mask = 0
+  for j in ids:
+    mask |= 1 << j
+  return mask
+
 def parse_scene(scene_dict, img_template: str):
   # return the parsed sentences from the dict
   objects = scene_dict["objects"]
@@ -278,6 +299,9 @@ def parse_scene(scene_dict, img_template: str):
       image_all.append(objds[i])
     image_2ids[objds[i]] = obj_inds
   print(image_2ids.keys())
+  # the id lists as frozensets, built once instead of list()/set() per description
+  image_2ids_fs = {k: frozenset(v) for k, v in image_2ids.items()}
+  image_2masks = {k: _ids_mask(v) for k, v in image_2ids.items()}
   # 2. extrinsic, object-level
   ## tree, node structure
   objects_structs = []
@@ -371,6 +395,8 @@ def parse_scene(scene_dict, img_template: str):
 
     objects_structs.append(full_current_objd)
   ## adjust the right names
+  # neighbour ids as frozensets, built once per scene instead of set(...) in every test
+  rel_sets = {d: [frozenset(x) for x in relationships[d]] for d in ('left', 'right', 'front', 'behind')}
   for i, object_struct in enumerate(objects_structs):
     # object-centric per relation processing
     object_struct['left'] = []
@@ -379,16 +405,16 @@ def parse_scene(scene_dict, img_template: str):
     object_struct['behind'] = []
     
     left_objects = object_struct["left_child"]
-    left_object_ids = relationships['left'][i]
+    left_object_ids = rel_sets['left'][i]
 
     right_objects = object_struct["right_child"]
-    right_object_ids = relationships['right'][i]
+    right_object_ids = rel_sets['right'][i]
 
     front_objects = object_struct["front_child"]
-    front_object_ids = relationships['front'][i]
+    front_object_ids = rel_sets['front'][i]
 
     behind_objects = object_struct["behind_child"]
-    behind_object_ids = relationships['behind'][i]
+    behind_object_ids = rel_sets['behind'][i]
     # process left
     for objectd_list in left_objects:
       # "big red rubber ball"
@@ -411,7 +437,7 @@ def parse_scene(scene_dict, img_template: str):
         # comb
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           #
           object_struct['left'].append("some "+comb4d)
           
@@ -423,7 +449,7 @@ def parse_scene(scene_dict, img_template: str):
       # 3d
       for comb3d in comb3d_lists:
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           object_struct['left'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["left"].append("Exactly one all "+comb3d)
@@ -433,7 +459,7 @@ def parse_scene(scene_dict, img_template: str):
       # 2d
       for comb2d in comb2d_lists:
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           object_struct['left'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["left"].append("Exactly one all "+comb2d)
@@ -443,7 +469,7 @@ def parse_scene(scene_dict, img_template: str):
       # 1d
       for comb1d in comb1d_lists:
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           object_struct['left'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["left"].append("Exactly one all "+comb1d)
@@ -474,7 +500,7 @@ def parse_scene(scene_dict, img_template: str):
         # comb
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           #
           object_struct['right'].append("some "+comb4d)
           
@@ -486,7 +512,7 @@ def parse_scene(scene_dict, img_template: str):
       # 3d
       for comb3d in comb3d_lists:
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           object_struct['right'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["right"].append("Exactly one all "+comb3d)
@@ -496,7 +522,7 @@ def parse_scene(scene_dict, img_template: str):
       # 2d
       for comb2d in comb2d_lists:
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           object_struct['right'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["right"].append("Exactly one all "+comb2d)
@@ -506,7 +532,7 @@ def parse_scene(scene_dict, img_template: str):
       # 1d
       for comb1d in comb1d_lists:
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           object_struct['right'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["right"].append("Exactly one all "+comb1d)
@@ -538,7 +564,7 @@ def parse_scene(scene_dict, img_template: str):
         # comb
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           #
           object_struct['front'].append("some "+comb4d)
           
@@ -551,7 +577,7 @@ def parse_scene(scene_dict, img_template: str):
       # 3d
       for comb3d in comb3d_lists:
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           object_struct['front'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["front"].append("Exactly one all "+comb3d)
@@ -561,7 +587,7 @@ def parse_scene(scene_dict, img_template: str):
       # 2d
       for comb2d in comb2d_lists:
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           object_struct['front'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["front"].append("Exactly one all "+comb2d)
@@ -571,7 +597,7 @@ def parse_scene(scene_dict, img_template: str):
       # 1d
       for comb1d in comb1d_lists:
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           object_struct['front'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["front"].append("Exactly one all "+comb1d)
@@ -603,7 +629,7 @@ def parse_scene(scene_dict, img_template: str):
         # comb
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           #
           object_struct['behind'].append("some "+comb4d)
           
@@ -616,7 +642,7 @@ def parse_scene(scene_dict, img_template: str):
       # 3d
       for comb3d in comb3d_lists:
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           object_struct['behind'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["behind"].append("Exactly one all "+comb3d)
@@ -626,7 +652,7 @@ def parse_scene(scene_dict, img_template: str):
       # 2d
       for comb2d in comb2d_lists:
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           object_struct['behind'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["behind"].append("Exactly one all "+comb2d)
@@ -636,207 +662,139 @@ def parse_scene(scene_dict, img_template: str):
       # 1d
       for comb1d in comb1d_lists:
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           object_struct['behind'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["behind"].append("Exactly one all "+comb1d)
         else:
           object_struct['behind'].append("all "+comb1d)
   # adjust the primary names
-  utterances = []
+  # bit-packed adjacency: bit j of rel_masks[d][i] is set when j is in
+  # relationships[d][i], so the set algebra below is integer AND/OR
+  rel_masks = {d: [_ids_mask(ids) for ids in relationships[d]] for d in ('left', 'right', 'front', 'behind')}
+  # covered_masks[(d, name)]: every object with at least one `name` object in
+  # direction d, shared by all primaries that test that "some" description
+  covered_masks = {}
+
+  def covered_mask(d, name):
+    key = (d, name)
+    mask = covered_masks.get(key)
+    if mask is None:
+      second_mask = image_2masks[name]
+      mask = 0
+      for object_id, rel_mask in enumerate(rel_masks[d]):
+        if rel_mask & second_mask:
+          mask |= 1 << object_id
+      covered_masks[key] = mask
+    return mask
+
+  # deduplicated as they are built; num_utterances keeps the raw count for the log
+  utterances = set()
+  num_utterances = 0
+
+  def emit(name_, primary_mask, descrips, rel_all, rel_some, prep):
+    # one relation of a "some" primary name: rel_all is tested against every
+    # object an "all" description names, rel_some against every primary object
+    for descrip in descrips:
+      count_mask = 0
+      some_flag = False
+      head, _, tail = descrip.partition(" ")
+      if head == "all" or head == "Exactly":
+        object_under_discuss_name = tail if head == "all" else tail[len("one all "):]
+        second_object_ids = image_2ids_fs[object_under_discuss_name] # green balls
+        for second_object_id in second_object_ids:
+          rel_mask = rel_masks[rel_all][second_object_id]
+          if primary_mask & ~rel_mask:
+            some_flag = True
+            count_mask |= primary_mask & rel_mask
+            # two or more counted ids: neither the quantifier nor "Exactly one" can change
+            if count_mask & (count_mask - 1):
+              break
+
+      elif head == "some":
+        covered = covered_mask(rel_some, tail)
+        count_mask = primary_mask & covered
+        some_flag = bool(primary_mask & ~covered)
+
+      if some_flag:
+        utterance = "some "+name_+prep+descrip
+      else:
+        utterance = "all "+name_+prep+descrip
+        if rel_some == 'left':
+          print("****", utterance)
+
+      # exactly one bit set
+      if count_mask and not count_mask & (count_mask - 1):
+        utterance = "Exactly one " + utterance
+      utterances.add(utterance)
+
   for i, object_struct in enumerate(objects_structs):
     # object-centric
     primary_names = object_struct["left_names"]
     for name in primary_names:
       if "some" in name:
-        name_ = copy.deepcopy(name)
+        name_ = name
         name_ = name_.replace("some ", "")
         if name_ == "objects":
             continue
-        primary_object_ids = set(image_2ids[name_]) # all
+        primary_mask = image_2masks[name_]
         
         # per relation
-        ## left
-        for descrip in object_struct['left']: # on the right of
-          count_ids = []
-          some_flag = False
-          #print(descrip)
-          
-          if "all"  in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            #print(descrip)
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['right'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['right'][second_object_id])):
-                  count_ids.append(temp)
-              
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['left'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-                
-          if some_flag:
-            utterances.append("some "+name_+" on the right of "+descrip)
-          else:
-            utterances.append("all "+name_+" on the right of "+descrip)
-            print("****", utterances[-1])
-            
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-            
-        ## right
-        for descrip in object_struct['right']:
-          count_ids = []
-          some_flag = False
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            #print(descrip)
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['left'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['left'][second_object_id])):
-                  count_ids.append(temp)
-            
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['right'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-                
-          if some_flag:
-            utterances.append("some "+name_+" on the left of "+descrip)
-          else:
-            utterances.append("all "+name_+" on the left of "+descrip)
-            #print("****", utterances[-1])
-
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-            
-        ## front
-        for descrip in object_struct['front']:
-          count_ids = []
-          some_flag = False
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['behind'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['behind'][second_object_id])):
-                  count_ids.append(temp)
-                  
-              
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['front'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-
-          if some_flag:
-            utterances.append("some "+name_+" behind "+descrip)
-          else:
-            utterances.append("all "+name_+" behind "+descrip)
-            #print("****", utterances[-1])
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
-                
-        ## behind
-        for descrip in object_struct['behind']:
-          some_flag = False
-          count_ids = []
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.split("all ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for second_object_id in second_object_ids:
-              #
-              if len(primary_object_ids - set(relationships['front'][second_object_id])) > 0:
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['front'][second_object_id])):
-                  count_ids.append(temp)
-              #elif not some_flag:
-              #  print("???????", descrip)
-              #  print(some_flag, name_)
-              #  print(primary_object_ids)
-              #  print(second_object_ids)
-                
-          elif "some" in descrip:
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
-            for primary_object_id in primary_object_ids:
-              if not set(relationships['behind'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
-              else:
-                count_ids.append(primary_object_id)
-
-          if some_flag:
-            utterances.append("some "+name_+" in front of "+descrip)
-          else:
-            utterances.append("all "+name_+" in front of "+descrip)
-            #print("****", utterances[-1])
-          count_ids = set(count_ids)  
-          if len(count_ids) == 1:
-            utterances[-1] = "Exactly one " + utterances[-1]
+        for descrips, rel_all, rel_some, prep in (
+            (object_struct['left'], 'right', 'left', " on the right of "),
+            (object_struct['right'], 'left', 'right', " on the left of "),
+            (object_struct['front'], 'behind', 'front', " behind "),
+            (object_struct['behind'], 'front', 'behind', " in front of ")):
+          emit(name_, primary_mask, descrips, rel_all, rel_some, prep)
+          num_utterances += len(descrips)
       else: # all
-        name_ = copy.deepcopy(name)
+        name_ = name
         name_ = name_.replace("all ", "")
         if name_ == "objects":
             continue
+        # a name that picks out no objects is malformed, fail as the "some" branch does
+        if name_ not in image_2ids:
+          raise KeyError(name_)
 
-        primary_object_ids = set(image_2ids[name_]) # all
         ## left
         for descrip_ in object_struct['left']:
           # All balls are on the right of xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
+          descrip = _QUANTIFIER_RE.sub("", descrip_)
           ## avoid trivial expressions
           if descrip == name_:
             continue
-          utterances.append("some " + name_ + "on the right of" + descrip)
+          utterances.add("some " + name_ + "on the right of" + descrip)
+          num_utterances += 1
 
         ## right
         for descrip_ in object_struct['right']:
           # All balls are on the left of xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
+          descrip = _QUANTIFIER_RE.sub("", descrip_)
           ## avoid trivial expressions
           if descrip == name_:
             continue
-          utterances.append("some " + name_ + "on the left of" + descrip)
+          utterances.add("some " + name_ + "on the left of" + descrip)
+          num_utterances += 1
 
         ## front
         for descrip_ in object_struct['front']:
           # All balls are behind xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
+          descrip = _QUANTIFIER_RE.sub("", descrip_)
           ## avoid trivial expressions
           if descrip == name_:
             continue
-          utterances.append("some " + name_ + "behind" + descrip)
+          utterances.add("some " + name_ + "behind" + descrip)
+          num_utterances += 1
           
         ## behind
         for descrip_ in object_struct['behind']:
           # All balls are on the front of xxx.
-          descrip = descrip_.replace("some ", "").replace("Exactly one all ", "").replace("all ", "")
+          descrip = _QUANTIFIER_RE.sub("", descrip_)
           ## avoid trivial expressions
           if descrip == name_:
             continue
-          utterances.append("some " + name_ + "on the front of" + descrip)
+          utterances.add("some " + name_ + "on the front of" + descrip)
+          num_utterances += 1
               
                 
   # intrinsic: image_some2ids.keys()/ image_all
@@ -845,12 +803,17 @@ def parse_scene(scene_dict, img_template: str):
   with open("../output/"+img_template.split(".")[0]+"_intrinsic.json", "w") as f:
     json.dump(intri_dict, f)
   # extrinsic: utterances
-  print("The number of utterances:", len(utterances))
-  for utterance in list(set(utterances)):
-    if not os.path.exists("../output/utterances/"):
-        os.mkdir("../output/utterances/")
-    with open("../output/utterances/"+utterance+".txt", "a") as f:
-      f.write(img_template)
+  print("The number of utterances:", num_utterances)
+  # every utterance file gets the same short record, so append it with a raw
+  # O_APPEND write instead of a buffered text file per utterance
+  payload = img_template.encode()
+  os.makedirs("../output/utterances/", exist_ok=True)
+  for utterance in utterances:
+    fd = os.open("../output/utterances/"+utterance+".txt", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+      os.write(fd, payload)
+    finally:
+      os.close(fd)
   
 def notmain(args):
   num_digits = 1
@@ -910,7 +873,7 @@ def notmain(args):
     'scenes': all_scenes
   }
   with open(args.output_scene_file, 'w') as f:
-    json.dump(output, f)
+    dump_json(output, f)
 
 def main(args):
   num_digits = 6
@@ -2369,6 +2332,8 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
 
     objects_structs.append(full_current_objd)
   ## adjust the right names
+  # neighbour ids as frozensets, built once per scene instead of set(...) in every test
+  rel_sets = {d: [frozenset(x) for x in relationships[d]] for d in ('left', 'right', 'front', 'behind')}
   for i, object_struct in enumerate(objects_structs):
     # object-centric per relation processing
     object_struct['left'] = []
@@ -2377,16 +2342,16 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
     object_struct['behind'] = []
     
     left_objects = object_struct["left_child"]
-    left_object_ids = relationships['left'][i]
+    left_object_ids = rel_sets['left'][i]
 
     right_objects = object_struct["right_child"]
-    right_object_ids = relationships['right'][i]
+    right_object_ids = rel_sets['right'][i]
 
     front_objects = object_struct["front_child"]
-    front_object_ids = relationships['front'][i]
+    front_object_ids = rel_sets['front'][i]
 
     behind_objects = object_struct["behind_child"]
-    behind_object_ids = relationships['behind'][i]
+    behind_object_ids = rel_sets['behind'][i]
     # process left
     for objectd_list in left_objects:
       # "big red rubber ball"
@@ -2415,7 +2380,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
         comb4d = " ".join(comb4d)
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           #
           object_struct['left'].append("some "+comb4d)
           
@@ -2428,7 +2393,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb3d in comb3d_lists:
         comb3d = " ".join(comb3d)
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           object_struct['left'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["left"].append("Exactly one all "+comb3d)
@@ -2439,7 +2404,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb2d in comb2d_lists:
         comb2d = " ".join(comb2d)
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           object_struct['left'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["left"].append("Exactly one all "+comb2d)
@@ -2450,7 +2415,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb1d in comb1d_lists:
         
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(left_object_ids)) > 0:
+        if len(set(all_ids)-left_object_ids) > 0:
           object_struct['left'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["left"].append("Exactly one all "+comb1d)
@@ -2488,7 +2453,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
         comb4d = " ".join(comb4d)
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           #
           object_struct['right'].append("some "+comb4d)
           
@@ -2501,7 +2466,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb3d in comb3d_lists:
         comb3d = " ".join(comb3d)
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           object_struct['right'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["right"].append("Exactly one all "+comb3d)
@@ -2512,7 +2477,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb2d in comb2d_lists:
         comb2d = " ".join(comb2d)
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           object_struct['right'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["right"].append("Exactly one all "+comb2d)
@@ -2523,7 +2488,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb1d in comb1d_lists:
        
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(right_object_ids)) > 0:
+        if len(set(all_ids)-right_object_ids) > 0:
           object_struct['right'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["right"].append("Exactly one all "+comb1d)
@@ -2559,7 +2524,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
         comb4d = " ".join(comb4d)
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           #
           object_struct['front'].append("some "+comb4d)
           
@@ -2573,7 +2538,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb3d in comb3d_lists:
         comb3d = " ".join(comb3d)
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           object_struct['front'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["front"].append("Exactly one all "+comb3d)
@@ -2584,7 +2549,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb2d in comb2d_lists:
         comb2d = " ".join(comb2d)
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           object_struct['front'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["front"].append("Exactly one all "+comb2d)
@@ -2595,7 +2560,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb1d in comb1d_lists:
     
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(front_object_ids)) > 0:
+        if len(set(all_ids)-front_object_ids) > 0:
           object_struct['front'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["front"].append("Exactly one all "+comb1d)
@@ -2632,7 +2597,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
         comb4d = " ".join(comb4d)
         all_ids = image_2ids[comb4d]
         
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           #
           object_struct['behind'].append("some "+comb4d)
           
@@ -2646,7 +2611,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb3d in comb3d_lists:
         comb3d = " ".join(comb3d)
         all_ids = image_2ids[comb3d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           object_struct['behind'].append("some "+comb3d)
         elif len(all_ids) == 1:
           object_struct["behind"].append("Exactly one all "+comb3d)
@@ -2657,7 +2622,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb2d in comb2d_lists:
         comb2d = " ".join(comb2d)
         all_ids = image_2ids[comb2d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           object_struct['behind'].append("some "+comb2d)
         elif len(all_ids) == 1:
           object_struct["behind"].append("Exactly one all "+comb2d)
@@ -2668,7 +2633,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
       for comb1d in comb1d_lists:
         
         all_ids = image_2ids[comb1d]
-        if len(set(all_ids)-set(behind_object_ids)) > 0:
+        if len(set(all_ids)-behind_object_ids) > 0:
           object_struct['behind'].append("some "+comb1d)
         elif len(all_ids) == 1:
           object_struct["behind"].append("Exactly one all "+comb1d)
@@ -2686,7 +2651,7 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
     primary_names = object_struct["left_names"]
     for name in primary_names: # some, all? 
       if "some" in name:
-        name_ = copy.deepcopy(name)
+        name_ = name
         name_ = name_.replace("some ", "")
         name_ = name_.replace("Exactly one ", "")
         if name_ == "objects":
@@ -2696,35 +2661,35 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
         # per relation
         ## left
         for descrip in object_struct['left']: # on the right of
-          count_ids = []
+          count_ids = set()
           some_flag = False
           exist_flag = False
           #print(descrip)
           
-          if "all"  in descrip.split(" "):
-            object_under_discuss_name = descrip.replace("small", "yeah").split("all ")[-1].replace("yeah", "small")
+          head, _, tail = descrip.partition(" ")
+          if head == "all" or head == "Exactly":
+            object_under_discuss_name = tail if head == "all" else tail[len("one all "):]
             #print(descrip)
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for second_object_id in second_object_ids:
               #
-              if len(primary_object_ids - set(relationships['right'][second_object_id])) > 0:
+              if len(primary_object_ids - rel_sets['right'][second_object_id]) > 0:
                 print(primary_object_ids)
                 print(set(relationships['right'][second_object_id]))
                 print("****right")
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['right'][second_object_id])):
-                  count_ids.append(temp)
+                some_flag = True
+                count_ids |= primary_object_ids & rel_sets['right'][second_object_id]
               
-          elif "some" in descrip:
+          elif head == "some":
             
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            object_under_discuss_name = tail
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for primary_object_id in primary_object_ids:
-              if not set(relationships['left'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
+              if rel_sets['left'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
               else:
-                count_ids.append(primary_object_id)
-              if len(set(second_object_ids) - set(relationships['left'][primary_object_id])) > 0:
+                count_ids.add(primary_object_id)
+              if not rel_sets['left'][primary_object_id].issuperset(second_object_ids):
                 exist_flag = True
                 
           if some_flag:
@@ -2736,41 +2701,40 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
             
           print("****", utterances[-1])
             
-          count_ids = set(count_ids)  
           if len(count_ids) == 1:
             utterances[-1] = "Exactly one " + utterances[-1]
           print(utterances[-1])
             
         ## right
         for descrip in object_struct['right']:
-          count_ids = []
+          count_ids = set()
           some_flag = False
           exist_flag = False
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.replace("small", "yeah").split("all ")[-1].replace("yeah", "small")
+          head, _, tail = descrip.partition(" ")
+          if head == "all" or head == "Exactly":
+            object_under_discuss_name = tail if head == "all" else tail[len("one all "):]
             #print(descrip)
             #print(descrip)
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for second_object_id in second_object_ids:
               #
-              if len(primary_object_ids - set(relationships['left'][second_object_id])) > 0:
+              if len(primary_object_ids - rel_sets['left'][second_object_id]) > 0:
                 print(primary_object_ids)
                 print(set(relationships['left'][second_object_id]))
                 print("****left")
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['left'][second_object_id])):
-                  count_ids.append(temp)
+                some_flag = True
+                count_ids |= primary_object_ids & rel_sets['left'][second_object_id]
             
-          elif "some" in descrip:
+          elif head == "some":
             
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            object_under_discuss_name = tail
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for primary_object_id in primary_object_ids:
-              if not set(relationships['right'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
+              if rel_sets['right'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
               else:
-                count_ids.append(primary_object_id)
-              if len(set(second_object_ids) - set(relationships['right'][primary_object_id])) > 0:
+                count_ids.add(primary_object_id)
+              if not rel_sets['right'][primary_object_id].issuperset(second_object_ids):
                 exist_flag = True
                 
           if some_flag:
@@ -2781,40 +2745,39 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
             utterances.append("some "+name_+" on the left of "+descrip)
             #print("****", utterances[-1])
 
-          count_ids = set(count_ids)  
           if len(count_ids) == 1:
             utterances[-1] = "Exactly one " + utterances[-1]
           print(utterances[-1])
         
         ## front
         for descrip in object_struct['front']:
-          count_ids = []
+          count_ids = set()
           some_flag = False
           exist_flag = False
-          if "all" in descrip.split(" "):
-            object_under_discuss_name = descrip.replace("small", "yeah").split("all ")[-1].replace("yeah", "small")
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+          head, _, tail = descrip.partition(" ")
+          if head == "all" or head == "Exactly":
+            object_under_discuss_name = tail if head == "all" else tail[len("one all "):]
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for second_object_id in second_object_ids:
               #
-              if len(primary_object_ids - set(relationships['behind'][second_object_id])) > 0:
+              if len(primary_object_ids - rel_sets['behind'][second_object_id]) > 0:
                 print(primary_object_ids)
                 print(set(relationships['behind'][second_object_id]))
                 print("****front")
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['behind'][second_object_id])):
-                  count_ids.append(temp)
+                some_flag = True
+                count_ids |= primary_object_ids & rel_sets['behind'][second_object_id]
                   
               
-          elif "some" in descrip:
+          elif head == "some":
             
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            object_under_discuss_name = tail
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for primary_object_id in primary_object_ids:
-              if not set(relationships['front'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
+              if rel_sets['front'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
               else:
-                count_ids.append(primary_object_id)
-              if len(set(second_object_ids) - set(relationships['front'][primary_object_id])) > 0:
+                count_ids.add(primary_object_id)
+              if not rel_sets['front'][primary_object_id].issuperset(second_object_ids):
                 exist_flag = True
 
           if some_flag:
@@ -2824,7 +2787,6 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
           if exist_flag:
             utterances.append("some "+name_+" behind "+descrip)
             #print("****", utterances[-1])
-          count_ids = set(count_ids)  
           if len(count_ids) == 1:
             utterances[-1] = "Exactly one " + utterances[-1]
           print(utterances[-1])    
@@ -2832,36 +2794,36 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
         for descrip in object_struct['behind']:
           some_flag = False
           exist_flag = False
-          count_ids = []
-          if "all" in descrip.split(" "):
+          count_ids = set()
+          head, _, tail = descrip.partition(" ")
+          if head == "all" or head == "Exactly":
             #print(descrip)
-            object_under_discuss_name = descrip.replace("small", "yeah").split("all ")[-1].replace("yeah", "small")
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            object_under_discuss_name = tail if head == "all" else tail[len("one all "):]
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for second_object_id in second_object_ids:
               #
-              if len(primary_object_ids - set(relationships['front'][second_object_id])) > 0:
+              if len(primary_object_ids - rel_sets['front'][second_object_id]) > 0:
                 print(primary_object_ids)
                 print(set(relationships['front'][second_object_id]))
                 print("****hihihi behind")
-                some_flag=True if some_flag == False else True
-                for temp in primary_object_ids-(primary_object_ids - set(relationships['front'][second_object_id])):
-                  count_ids.append(temp)
+                some_flag = True
+                count_ids |= primary_object_ids & rel_sets['front'][second_object_id]
               #elif not some_flag:
               #  print("???????", descrip)
               #  print(some_flag, name_)
               #  print(primary_object_ids)
               #  print(second_object_ids)
                 
-          elif "some" in descrip:
+          elif head == "some":
             
-            object_under_discuss_name = descrip.split("some ")[-1]
-            second_object_ids = list(image_2ids[object_under_discuss_name]) # green balls
+            object_under_discuss_name = tail
+            second_object_ids = image_2ids[object_under_discuss_name] # green balls
             for primary_object_id in primary_object_ids:
-              if not set(relationships['behind'][primary_object_id]).intersection(set(second_object_ids)):
-                some_flag=True if some_flag == False else True
+              if rel_sets['behind'][primary_object_id].isdisjoint(second_object_ids):
+                some_flag = True
               else:
-                count_ids.append(primary_object_id)
-              if len(set(second_object_ids) - set(relationships['behind'][primary_object_id])) > 0:
+                count_ids.add(primary_object_id)
+              if not rel_sets['behind'][primary_object_id].issuperset(second_object_ids):
                 exist_flag = True
 
           if some_flag:
@@ -2871,12 +2833,11 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
           if exist_flag:
             utterances.append("some "+name_+" on the front of "+descrip)
             #print("****", utterances[-1])
-          count_ids = set(count_ids)  
           if len(count_ids) == 1:
             utterances[-1] = "Exactly one " + utterances[-1]
           print(utterances[-1])
       else: # all
-        name_ = copy.deepcopy(name)
+        name_ = name
         
         name_ = name_.replace("Exactly one ", "")
         if 'all' in name_.split(" ")[0]:
@@ -2952,8 +2913,8 @@ def parse_scene_struct(scene_dict, main_name, aux_name):
     
     
     if main_name in temp[0] and aux_name in temp[1]:
-      first_sec = copy.deepcopy(temp[0])
-      last_sec = copy.deepcopy(temp[1])
+      first_sec = temp[0]
+      last_sec = temp[1]
       print(first_sec, last_sec)
       
       flag = True
@@ -3101,7 +3062,7 @@ def render_scene(args,
       print(e)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
@@ -3235,7 +3196,7 @@ def render_ad_hoc_scene(args,
       print(e)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
@@ -3384,7 +3345,7 @@ def render_and_connective_scene(args,
     
   render_mask_shadeless(blender_objects, output_mask)
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
   
   #if jsonl_path:
   with open(jsonl_path, 'a+') as f:
@@ -3549,7 +3510,7 @@ def render_or_connective_scene(args,
   render_mask_shadeless(blender_objects, output_mask)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
   
   #if jsonl_path:
   
@@ -3700,7 +3661,7 @@ def render_no_connective_scene(args,
   render_mask_shadeless(blender_objects, output_mask)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
   
   with open(jsonl_path, 'a') as f:
     f.write(json.dumps(scene_struct))
@@ -3851,7 +3812,7 @@ def render_random_extrinsic_scene(args,
       print(e)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
@@ -3998,7 +3959,7 @@ def render_some_intrinsic_scene(args,
       print(e)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
     
   render_mask_shadeless(blender_objects, output_mask)
 
@@ -4150,7 +4111,7 @@ def render_all_intrinsic_scene(args,
       print(e)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
     
   render_mask_shadeless(blender_objects, output_mask)
   
@@ -4301,7 +4262,7 @@ def render_no_intrinsic_scene(args,
   render_mask_shadeless(blender_objects, output_mask)
 
   with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f)
+    dump_json(scene_struct, f)
     
   with open(jsonl_path, 'a+') as f:
     if flag:
@@ -4436,46 +4397,19 @@ def add_random_objects(scene_struct, num_objects, args, camera):
   return objects, blender_objects
 
 def calculate_ad_hoc_matrix(objects):
-  utterance_lists = {}
   # measure existence
-  objects_whole_string = {}
-  for i, obj in enumerate(objects):
-    string = obj['shape']+obj['size']+obj['material']+obj['color']
-    if string not in objects_whole_string:
-      objects_whole_string[string] = 1
-    else:
-      objects_whole_string[string] += 1
-    if obj['shape'] not in utterance_lists:
-      utterance_lists[obj['shape']] = np.zeros(len(objects))
-      utterance_lists[obj['shape']][i] = 1
-    else:
-      utterance_lists[obj['shape']][i] += 1
-      
-    if obj['size'] not in utterance_lists:
-      utterance_lists[obj['size']] = np.zeros(len(objects))
-      utterance_lists[obj['size']][i] = 1
-    else:
-      utterance_lists[obj['size']][i] += 1
-    
-    if obj['material'] not in utterance_lists:
-      utterance_lists[obj['material']] = np.zeros(len(objects))
-      utterance_lists[obj['material']][i] = 1
-    else:
-      utterance_lists[obj['material']][i] += 1
-    
-    if obj['color'] not in utterance_lists:
-      utterance_lists[obj['color']] = np.zeros(len(objects))
-      utterance_lists[obj['color']][i] = 1
-    else:
-      utterance_lists[obj['color']][i] += 1
-  
+  objects_whole_string = Counter(obj['shape']+obj['size']+obj['material']+obj['color'] for obj in objects)
+  # one row per attribute value, in order of first appearance, with a 1 in the
+  # column of every object carrying it
+  key_ids = {}
+  rows = np.array([[key_ids.setdefault(obj[attr], len(key_ids)) for attr in ('shape', 'size', 'material', 'color')]
+                   for obj in objects], dtype=np.intp).reshape(len(objects), 4)
+  full_matrix = np.zeros((len(key_ids), len(objects)))
+  np.add.at(full_matrix, (rows, np.arange(len(objects))[:, None]), 1)
+  keys = list(key_ids)
 
   # process the column
-  full_matrix = np.zeros((len(utterance_lists.keys()), len(objects)))
-  keys = list(utterance_lists.keys())
-  for i, key in enumerate(keys):
-    utterance_lists[key] = utterance_lists[key]/(np.sum(utterance_lists[key])+1e-3)
-    full_matrix[i] = utterance_lists[key]
+  full_matrix = full_matrix/(full_matrix.sum(axis=1, keepdims=True)+1e-3)
   # transpose the matrix
   utterance_obj_pairs = []
   repeat_obj_pairs = []